@@ -0,0 +1,109 @@
+# Benchmark of writing posts to and saving a large JSON database, comparing the database that keeps track of
+# the rows in the file with the previous implementation, which searched the whole file for every post written
+# and wrote the file anew line by line when saving.
+#
+# Run from the repository root: python benchmarks/database.py [rows]
+import json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Paths in settings are relative to the working directory, so the database is written to a temporary directory.
+os.chdir(tempfile.mkdtemp())
+os.makedirs("db", exist_ok=True)
+
+from loguru import logger
+
+logger.remove()
+
+from local import db
+from settings.paths import database_path
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+# Half of the posts written are new, the other half update posts already in the database.
+WRITES = 100
+FAILED = {"twitter": 0, "mastodon": 0}
+
+
+def skeet(i):
+    return "bafyrei%040d" % i
+
+
+# The posts are recent, so that saving the database does not move them to the archive.
+def create_database():
+    now = int(time.time())
+    with open(database_path, "w") as file:
+        for i in range(ROWS):
+            ids = {"twitter_id": str(10**18 + i), "mastodon_id": str(10**17 + i)}
+            row = {"skeet": skeet(i), "ids": ids, "failed": FAILED, "timestamp": now}
+            file.write(json.dumps(row) + "\n")
+    for path in (db.database_index_path, db.database_meta_path, db.database_changes_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def writes():
+    for i in range(WRITES // 2):
+        yield "newpost%s" % i, str(i), str(i)
+    for i in range(WRITES // 2):
+        yield skeet(i), "x", "y"
+
+
+# The previous implementation, which read the whole database into a dictionary.
+def previous_read():
+    database = {}
+    with open(database_path, "r") as file:
+        for line in file:
+            json_line = json.loads(line)
+            database[json_line["skeet"]] = {"ids": json_line["ids"], "failed": json_line["failed"]}
+    return database
+
+
+def previous_write(skeet, tweet, toot, failed, database):
+    ids = {"twitter_id": tweet, "mastodon_id": toot}
+    database[skeet] = {"ids": ids, "failed": failed}
+    json_string = json.dumps({"skeet": skeet, "ids": ids, "failed": failed})
+    with open(database_path, "r") as file:
+        found = json_string in file.read()
+    if not found:
+        with open(database_path, "a") as file:
+            file.write(json_string + "\n")
+    return database
+
+
+def previous_save(database):
+    append_write = "w"
+    for skeet in database:
+        row = {"skeet": skeet, "ids": database[skeet]["ids"], "failed": database[skeet]["failed"]}
+        file = open(database_path, append_write)
+        file.write(json.dumps(row) + "\n")
+        file.close()
+        append_write = "a"
+
+
+def measure(name, read, write, save):
+    create_database()
+    start = time.perf_counter()
+    database = read()
+    read_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for skeet, tweet, toot in writes():
+        database = write(skeet, tweet, toot, FAILED, database)
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    save(database)
+    save_time = time.perf_counter() - start
+    print(
+        "%-8s read %6.2fs   %s db_write %6.2fs   save_db %6.2fs"
+        % (name, read_time, WRITES, write_time, save_time)
+    )
+    return database
+
+
+if __name__ == "__main__":
+    print("%s rows" % ROWS)
+    measure("previous", previous_read, previous_write, previous_save)
+    database = measure("current", db.db_read, db.db_write, db.save_db)
+    # The first read builds the index of the database file, later runs only map it.
+    start = time.perf_counter()
+    database.close()
+    database = db.db_read()
+    print("current  reopening the indexed database %.3fs" % (time.perf_counter() - start))
@@ -0,0 +1,118 @@
+# Microbenchmark of rewriting the text of a post for crossposting, comparing rewrite_text, which builds the new
+# text in one pass over the byte offsets of the facets, with the previous implementation, which removed tags and
+# then called text.replace() once for every link and mention facet.
+#
+# Run from the repository root: python benchmarks/facets.py
+import os, sys, tempfile, timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Paths in settings are relative to the working directory, so state files are written to a temporary directory.
+os.chdir(tempfile.mkdtemp())
+
+from loguru import logger
+
+logger.remove()
+
+from input.bluesky import LINK_FACET, MENTION_FACET, rewrite_text
+from settings import settings
+
+REPEAT = 5
+
+
+def facet(start, end, py_type, **feature):
+    return SimpleNamespace(
+        index=SimpleNamespace(byte_start=start, byte_end=end),
+        features=[SimpleNamespace(py_type=py_type, **feature)],
+    )
+
+
+# Builds a post record from pieces of text, where (text, facet type, feature) tuples are covered by a facet.
+def record(pieces):
+    text = b""
+    facets = []
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            covered, py_type, feature = piece
+            start = len(text)
+            text += covered.encode()
+            facets.append(facet(start, len(text), py_type, **feature))
+        else:
+            text += piece.encode()
+    return SimpleNamespace(text=text.decode(), facets=facets)
+
+
+def mention(i):
+    return ("@user%s.bsky.social" % i, MENTION_FACET, {"did": "did:plc:user%s" % i})
+
+
+def link(i):
+    return ("site%s.example/pa..." % i, LINK_FACET, {"uri": "https://site%s.example/path/to/page" % i})
+
+
+POSTS = {
+    "emoji-heavy": record(
+        [piece for i in range(8) for piece in ("😀🎉 café ", mention(i), " 🇸🇪👨‍👩‍👧 ")] + ["#emoji"]
+    ),
+    "link-heavy": record([piece for i in range(20) for piece in ("link ", link(i), " ")] + ["#links"]),
+    "long post": record([piece for i in range(100) for piece in ("x ", link(i), " 😀 ")] + ["#long"]),
+}
+
+
+# The previous implementation.
+def previous_remove_tags(text):
+    return " ".join(word for word in text.split() if not word.startswith("#"))
+
+
+def previous_remove_ignored_tags(text):
+    found_ignored_tag = False
+    for tag in settings.ignore_tags_twitter + settings.ignore_tags_mastodon:
+        if tag in text:
+            found_ignored_tag = True
+        text = text.replace(tag, "").strip()
+    return text, found_ignored_tag
+
+
+def previous_restore_urls(record, text):
+    encoded_text = text.encode("UTF-8")
+    for facet in record.facets:
+        if facet.features[0].py_type != LINK_FACET:
+            continue
+        start = facet.index.byte_start
+        end = facet.index.byte_end
+        text = text.replace(encoded_text[start:end].decode("UTF-8"), facet.features[0].uri)
+    return text
+
+
+def previous_handle_mentions(record, text):
+    encoded_text = text.encode("UTF-8")
+    for facet in record.facets:
+        if facet.features[0].py_type != MENTION_FACET:
+            continue
+        username = encoded_text[facet.index.byte_start : facet.index.byte_end].decode("UTF-8")
+        text = text.replace(username, "https://bsky.app/profile/" + facet.features[0].did)
+    return text, True
+
+
+def previous_rewrite_text(record, text):
+    text = previous_remove_tags(text)
+    text, _ = previous_remove_ignored_tags(text)
+    text = previous_restore_urls(record, text)
+    return previous_handle_mentions(record, text)
+
+
+def measure(function, post, number):
+    return min(timeit.repeat(lambda: function(post, post.text), number=number, repeat=REPEAT)) / number * 1e6
+
+
+if __name__ == "__main__":
+    settings.mentions = "url"
+    print("Best of %s runs, per call" % REPEAT)
+    for name, post in POSTS.items():
+        number = max(200_000 // len(post.text), 100)
+        previous = measure(previous_rewrite_text, post, number)
+        current = measure(rewrite_text, post, number)
+        print(
+            "%-12s %5s bytes %4s facets   previous %7.1f us   current %7.1f us"
+            % (name, len(post.text.encode()), len(post.facets), previous, current)
+        )
@@ -0,0 +1,190 @@
+# Benchmark of uploading the media of a post to Twitter, comparing the chunked upload, which uploads all files
+# at the same time and polls their processing, with the previous implementation, which uploaded the files one
+# at a time with media_upload. The uploads are sent to a local mock of the upload endpoint that adds latency
+# to every request, limits the upload speed and takes a while to process videos.
+#
+# Run from the repository root: python benchmarks/twitter_media.py
+import datetime, io, ipaddress, json, os, re, ssl, sys, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Paths in settings are relative to the working directory, so state files are written to a temporary directory.
+os.chdir(tempfile.mkdtemp())
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from loguru import logger
+
+logger.remove()
+
+import tweepy
+import output.twitter as twitter
+
+# Seconds added to every request, upload speed in bytes per second and seconds it takes to process a video.
+LATENCY = 0.15
+UPLOAD_SPEED = 50e6
+PROCESSING_TIME = 1.5
+IMAGES = 4
+IMAGE_SIZE = 900_000
+VIDEO_SIZE = 30_000_000
+
+
+# Tweepy only talks to the API over HTTPS, so the mock is served with a self-signed certificate.
+def certificate():
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    with open("cert.pem", "wb") as file:
+        file.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open("key.pem", "wb") as file:
+        file.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return os.path.abspath("cert.pem"), os.path.abspath("key.pem")
+
+
+def form_fields(headers, body):
+    content_type = headers.get("Content-Type", "")
+    if "multipart" not in content_type:
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+    fields = {}
+    boundary = content_type.split("boundary=")[1].encode()
+    for part in body.split(b"--" + boundary)[1:-1]:
+        head, _, value = part.partition(b"\r\n\r\n")
+        name = re.search(rb'name="([^"]+)"', head).group(1).decode()
+        fields[name] = value[:-2].decode(errors="replace")
+    return fields
+
+
+# Media IDs of videos being processed, with the time processing is done.
+processing = {}
+lock = threading.Lock()
+next_id = [1000]
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, code, data=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def media(self, media_id, state=None):
+        data = {"media_id": media_id, "media_id_string": str(media_id)}
+        if state:
+            data["processing_info"] = {"state": state, "check_after_secs": 1}
+        return data
+
+    # STATUS
+    def do_GET(self):
+        time.sleep(LATENCY)
+        media_id = int(parse_qs(urlparse(self.path).query)["media_id"][0])
+        done = time.time() >= processing.get(media_id, 0)
+        self.reply(200, self.media(media_id, "succeeded" if done else "in_progress"))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(LATENCY + len(body) / UPLOAD_SPEED)
+        if "metadata" in self.path:
+            return self.reply(200, {})
+        fields = form_fields(self.headers, body)
+        command = fields.get("command")
+        if command == "APPEND":
+            return self.reply(204)
+        if command == "FINALIZE":
+            media_id = int(fields["media_id"])
+            if media_id in processing:
+                processing[media_id] = time.time() + PROCESSING_TIME
+                return self.reply(200, self.media(media_id, "pending"))
+            return self.reply(200, self.media(media_id))
+        with lock:
+            next_id[0] += 1
+            media_id = next_id[0]
+        if command == "INIT" and "video" in fields.get("media_type", ""):
+            processing[media_id] = None
+        # INIT, or a simple upload of the whole file.
+        self.reply(202 if command == "INIT" else 200, self.media(media_id))
+
+    def log_message(self, *args):
+        pass
+
+
+class MediaFile:
+    def __init__(self, data):
+        self.data = data
+
+    def open(self):
+        return io.BufferedReader(io.BytesIO(self.data))
+
+
+def media_item(filename, mime_type, size):
+    return {"file": MediaFile(os.urandom(size)), "filename": filename, "mime_type": mime_type, "alt": "alt"}
+
+
+def media_items(kind):
+    if kind == "images":
+        return [media_item("%s.jpg" % i, "image/jpeg", IMAGE_SIZE) for i in range(IMAGES)]
+    return [media_item("video.mp4", "video/mp4", VIDEO_SIZE)]
+
+
+# The previous implementation, which uploaded one file at a time.
+def previous_upload_media(items):
+    media_ids = []
+    for item in items:
+        with item["file"].open() as file:
+            media_id = twitter.twitter_api.media_upload(item["filename"], file=file).media_id
+        if item["alt"]:
+            twitter.twitter_api.create_media_metadata(media_id, item["alt"])
+        media_ids.append(media_id)
+    return media_ids
+
+
+if __name__ == "__main__":
+    cert_path, key_path = certificate()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UploadHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["REQUESTS_CA_BUNDLE"] = cert_path
+    host = "127.0.0.1:%s" % server.server_address[1]
+    auth = tweepy.OAuth1UserHandler("key", "secret", "token", "secret")
+    twitter.twitter_api = tweepy.API(auth, host=host, upload_host=host)
+    print(
+        "%s ms latency, %s MB/s upload, %ss video processing"
+        % (int(LATENCY * 1000), int(UPLOAD_SPEED / 1e6), PROCESSING_TIME)
+    )
+    for kind, description in (
+        ("images", "%s images (%.1f MB each)" % (IMAGES, IMAGE_SIZE / 1e6)),
+        ("video", "1 video (%s MB)" % int(VIDEO_SIZE / 1e6)),
+    ):
+        for name, upload in (("previous", previous_upload_media), ("chunked", twitter.upload_media)):
+            items = media_items(kind)
+            start = time.perf_counter()
+            upload(items)
+            print("%-24s %-8s %5.2fs" % (description, name, time.perf_counter() - start))
@@ -1,4 +1,9 @@
-import traceback, sys
+import time
+
+# Taken before the heavy imports below, so that the cost of a cold start can be reported.
+start_time = time.perf_counter()
+
+import traceback, sys, argparse, asyncio
 import arrow
 from settings.auth import *
 from settings.paths import *
@@ -7,43 +12,58 @@ from local.functions import (
     cleanup,
     post_cache_read,
     post_cache_write,
+    post_cache_prune,
     get_post_time_limit,
     check_rate_limit,
+    feed_watermark_read,
+    feed_watermark_write,
     logger,
 )
-from local.db import db_read, db_backup, save_db
-from input.bluesky import get_posts
-from output.post import post, delete
+from local.db import db_read, db_backup, db_restore, save_db
+from local.ratelimit import limiter
+from local.outbox import outbox
+from local.journal import journal
+from input.bluesky import get_posts, get_watermark
+from input.jetstream import subscribe, events_to_posts
+from output.post import post, delete, with_due_retries, reconcile
 from input.bluesky import bsky_connect
-from output.twitter import twitter_api
+from output.twitter import TWEET_ENDPOINT, MEDIA_ENDPOINT
+
+# The shortest time the daemon waits between cycles.
+MIN_WAIT = 60
 
 
-def run():
+# Runs a single crossposting cycle. When running as a daemon, the state dictionary keeps the Bluesky client,
+# the database and the post cache in memory between cycles, so they only have to be set up on the first run.
+def run(state=None):
+    if state is None:
+        state = {}
     if check_rate_limit():
-        exit()
-    database = db_read()
-    post_cache = post_cache_read()
+        return
+    if "bsky" not in state:
+        state["bsky"] = bsky_connect()
+    bsky = state["bsky"]
+    if "database" not in state:
+        state["database"] = db_read()
+        reconcile(state["database"])
+    if "post_cache" in state:
+        post_cache = post_cache_prune(state["post_cache"])
+    else:
+        post_cache = post_cache_read()
     # Putting all of the recently posted posts in a list and removing them as they are found in the timeline.
     # Any posts not found in the timeline are posts that have been deleted.
     deleted = list(post_cache.keys())
     timelimit = get_post_time_limit(post_cache)
-    posts, deleted = get_posts(timelimit, deleted)
-    logger.debug(post_cache)
-    if deleted:
-        database, post_cache = delete(deleted, post_cache, database)
-        updates = True
-    logger.debug(post_cache)
-    updates, database, post_cache = post(posts, database, post_cache)
-    post_cache_write(post_cache)
-    if updates:
-        save_db(database)
-        cleanup()
-    db_backup()
+    watermark = feed_watermark_read()
+    posts, deleted = get_posts(timelimit, deleted, bsky, watermark)
+    publish(posts, deleted, state, post_cache)
+    new_watermark = get_watermark(posts, state["database"], watermark)
+    if new_watermark != watermark:
+        feed_watermark_write(*new_watermark)
     if not posts:
         logger.info("No new posts found.")
 
     # Get Bluesky rate limit info
-    bsky = bsky_connect()
     _, bsky_remaining, bsky_reset = bsky.get_rate_limit()
     if bsky_reset:
         bsky_reset_time = arrow.Arrow.fromtimestamp(bsky_reset).format("HH:mm:ss")
@@ -51,38 +71,155 @@ def run():
             f"Bluesky API calls remaining: {bsky_remaining}, resets at: {bsky_reset_time}"
         )
 
-    # Get Twitter rate limit info if Twitter posting is enabled
+    # Twitter rate limits are read from the headers of the tweets and media uploads sent, so reporting them
+    # takes no extra requests. They are kept between runs, so the last known state is reported.
     if settings.Twitter:
-        try:
-            from output.twitter import twitter_api
-            twitter_limits = twitter_api.rate_limit_status()
-            
-            # Get rate limits for status updates endpoint
-            status_limits = twitter_limits.get('resources', {}).get('statuses', {})
-            update_endpoint = next(
-                (v for k, v in status_limits.items() if 'update' in k.lower()),
-                None
-            )
-
-            if update_endpoint:
-                twitter_reset_time = arrow.Arrow.fromtimestamp(
-                    update_endpoint['reset']
-                ).format("HH:mm:ss")
-                twitter_remaining = update_endpoint['remaining']
+        for endpoint, name in ((TWEET_ENDPOINT, "tweets"), (MEDIA_ENDPOINT, "media uploads")):
+            _, twitter_remaining, twitter_reset = limiter.status("twitter", endpoint)
+            if twitter_reset:
+                twitter_reset_time = arrow.Arrow.fromtimestamp(twitter_reset).format("HH:mm:ss")
                 logger.info(
-                    f"Twitter API calls remaining: {twitter_remaining}, resets at: {twitter_reset_time}"
+                    f"Twitter {name} remaining: {twitter_remaining}, resets at: {twitter_reset_time}"
                 )
-            else:
-                logger.warning("Could not find status update endpoint rate limit info")
-                
-        except Exception as e:
-            logger.error(f"Error getting Twitter rate limits: {e}")
+
+
+# Deletes and crossposts the gathered posts and saves the results. Shared by regular runs and streaming mode.
+def publish(posts, deleted, state, post_cache):
+    database = state["database"]
+    logger.debug(post_cache)
+    updates = False
+    if deleted:
+        database, post_cache = delete(deleted, post_cache, database)
+        updates = True
+        for cid in deleted:
+            outbox.discard(cid)
+    logger.debug(post_cache)
+    # Posts that failed earlier are sent again from the outbox once they are due, without fetching them again.
+    posted, database, post_cache = post(with_due_retries(posts), database, post_cache)
+    updates = updates or posted
+    post_cache_write(post_cache)
+    state["database"] = database
+    state["post_cache"] = post_cache
+    if updates:
+        save_db(database)
+    # All posts have been saved, so the outcomes in the publish journal are no longer needed.
+    journal.compact()
+    cleanup()
+    db_backup(database)
+    limiter.save()
+    retry = limiter.next_retry()
+    if retry:
+        logger.info(
+            "Some posts were deferred by rate limits, they can be sent again at %s"
+            % arrow.Arrow.fromtimestamp(retry).format("HH:mm:ss")
+        )
+
+
+# Crossposts posts as soon as they are made, by subscribing to the account's events on Jetstream
+# instead of polling the author feed.
+def stream():
+    state = {"bsky": bsky_connect(), "database": db_read(), "post_cache": post_cache_read()}
+    bsky = state["bsky"]
+    reconcile(state["database"])
+
+    # Returns whether the events were processed. If not, they are received again when the subscription resumes.
+    def handle(events, rkeys):
+        if check_rate_limit():
+            return False
+        try:
+            post_cache = post_cache_prune(state["post_cache"])
+            timelimit = get_post_time_limit(post_cache)
+            posts, deleted = events_to_posts(events, bsky, timelimit, rkeys, post_cache)
+            if posts or deleted or outbox.due():
+                publish(posts, deleted, state, post_cache)
+        except Exception:
+            logger.error(traceback.format_exc())
+            return False
+        return True
+
+    # Posts deferred by a rate limit or waiting in the outbox are sent once they are due, also while no events
+    # arrive, but never sooner than MIN_WAIT seconds apart, like in daemon mode.
+    def wakeup():
+        now = time.time()
+        retries = [retry for retry in (limiter.next_retry(), outbox.next_due()) if retry]
+        if outbox.due():
+            retries.append(now)
+        if not retries:
+            return None
+        return max(min(retries), now + min(MIN_WAIT, settings.run_interval))
+
+    logger.info("Starting crossposter in streaming mode.")
+    asyncio.run(subscribe(bsky.me.did, handle, wakeup=wakeup))
+
+
+# Keeps a single process running and runs the crossposter every run_interval seconds. Imports, API clients,
+# the Bluesky session (which refreshes its own tokens), the database and the post cache all stay warm between
+# cycles, instead of being set up again by a fresh process every time like run.sh used to do.
+def daemon():
+    startup = time.perf_counter() - start_time
+    logger.info(
+        "Starting crossposter in daemon mode, running every %s seconds." % settings.run_interval
+    )
+    state = {}
+    cycle = 0
+    cold_cost = None
+    while True:
+        cycle += 1
+        cycle_start = time.perf_counter()
+        try:
+            run(state)
+        except (Exception, SystemExit):
+            logger.error(traceback.format_exc())
+        elapsed = time.perf_counter() - cycle_start
+        if cold_cost is None:
+            # The first cycle pays the same setup costs as a one-shot run.
+            cold_cost = startup + elapsed
+            logger.info("Cycle %s finished in %.2fs (cold start)." % (cycle, cold_cost))
+        else:
+            logger.info(
+                "Cycle %s finished in %.2fs (one-shot run cost: %.2fs, saved %.2fs)."
+                % (cycle, elapsed, cold_cost, cold_cost - elapsed)
+            )
+        # Posts deferred by a rate limit or waiting in the outbox are sent as soon as they are due, if that is
+        # before the next cycle, but never sooner than MIN_WAIT seconds so that Bluesky is not polled in a loop.
+        wait = settings.run_interval - elapsed
+        for retry in (limiter.next_retry(), outbox.next_due()):
+            if retry:
+                wait = min(wait, retry - time.time())
+        time.sleep(max(min(MIN_WAIT, settings.run_interval), wait))
 
 
 # Here the whole thing is run
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crosspost from Bluesky to Twitter and Mastodon.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and crosspost every run_interval seconds",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="crosspost posts as soon as they are made, using Bluesky's Jetstream",
+    )
+    parser.add_argument(
+        "--restore",
+        action="store_true",
+        help="restore the database from the latest backup and exit",
+    )
+    args = parser.parse_args()
     try:
-        run()
+        if args.restore:
+            sys.exit(0 if db_restore() else -1)
+        elif args.stream:
+            stream()
+        elif args.daemon:
+            daemon()
+        else:
+            run()
+            logger.info("Run finished in %.2fs." % (time.perf_counter() - start_time))
+    except KeyboardInterrupt:
+        logger.info("Crossposter stopped.")
     except Exception as e:
         logger.error(traceback.format_exc())
         sys.exit(-1)
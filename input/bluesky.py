@@ -1,31 +1,60 @@
 import os
+import re
 import arrow
 from loguru import logger
 from settings import settings
 from settings.auth import BSKY_HANDLE, BSKY_PASSWORD
-from settings.paths import session_cache_path
+from settings.paths import session_cache_path, identity_cache_path, reply_parent_cache_path
+from atproto import IdResolver
+from local.outbox import outbox
+from local.tags import ignored_tags
 from local.functions import (
+    PersistentCache,
     RateLimitedClient,
     lang_toggle,
-    rate_limit_write,
     session_cache_read,
-    session_cache_write,
-    on_session_change,
 )
 
 DATE_FORMAT = "YYYY-MM-DDTHH:mm:ss"
+# Author feed filter that leaves out replies to other users, and the largest page size allowed.
+FEED_FILTER = "posts_and_author_threads"
+FEED_PAGE_LIMIT = 100
+# DID documents rarely change, so they are only looked up again once a day. bsky.social is used for accounts
+# whose DID document could not be resolved, since it redirects requests for blobs to the right server.
+IDENTITY_TTL = 24 * 60 * 60
+FAILED_TTL = 10 * 60
+DEFAULT_PDS = "https://bsky.social"
+identity_cache = PersistentCache(identity_cache_path, IDENTITY_TTL)
+# app.bsky.feed.getPosts accepts at most 25 URIs per request.
+GET_POSTS_LIMIT = 25
+# The authors of posts that have been replied to, which are kept for a week.
+REPLY_PARENT_TTL = 7 * 24 * 60 * 60
+reply_parent_cache = PersistentCache(reply_parent_cache_path, REPLY_PARENT_TTL)
+id_resolver = IdResolver(timeout=10)
+LINK_FACET = "app.bsky.richtext.facet#link"
+MENTION_FACET = "app.bsky.richtext.facet#mention"
+# Hashtags are words starting with #, which are removed from posts along with the tags in them.
+HASHTAG_PATTERN = re.compile(r"(?<!\S)#\S*")
+WORD_HEAD_PATTERN = re.compile(r"\S*")
+# The client returned by bsky_connect, kept for the lifetime of the process.
+bsky_client = None
 
 
 def bsky_connect():
     """
-    Establish a connection to Bluesky, handling session management and rate limits.
+    Returns the authenticated Bluesky client shared by everything in the process, logging in on the first call.
+
+    The saved session is reused when there is one, since createSession is strictly rate limited per account.
+    From then on the client refreshes its own tokens before they expire and saves them when they change.
 
     Returns:
         RateLimitedClient: An authenticated Bluesky client instance.
     """
+    global bsky_client
+    if bsky_client is not None:
+        return bsky_client
     try:
         bsky = RateLimitedClient()
-        bsky.on_session_change(on_session_change)
         session = session_cache_read()
         if session:
             logger.info("Connecting to Bluesky using saved session.")
@@ -33,43 +62,136 @@ def bsky_connect():
         else:
             logger.info("Creating new Bluesky session using username and password.")
             bsky.login(BSKY_HANDLE, BSKY_PASSWORD)
-        session_cache_write(bsky.export_session_string())
+        bsky_client = bsky
         return bsky
     except Exception as e:
         logger.error(f"Error connecting to Bluesky: {e}")
+        # Rate limits are recorded by the client, so only an expired session has to be handled here.
         if hasattr(e, "response") and hasattr(e.response, "content"):
-            if e.response.content.error == "RateLimitExceeded":
-                ratelimit_reset = e.response.headers.get("RateLimit-Reset")
-                rate_limit_write(ratelimit_reset)
-            elif e.response.content.error == "ExpiredToken":
+            if e.response.content.error == "ExpiredToken":
                 logger.info("Session expired, removing session file.")
                 if os.path.exists(session_cache_path):
                     os.remove(session_cache_path)
         exit()
 
-def remove_tags(text):
+def rewrite_text(record, text):
+    """
+    Rewrites the text of a post for crossposting in a single pass over it.
+
+    Links shortened by Bluesky are restored and mentions are handled as set in settings, by replacing the
+    text each facet covers at its byte offsets. Hashtags, which include the ignored tags, are removed and all
+    whitespace is collapsed to single spaces.
+
+    Args:
+        record: The post record containing facets.
+        text (str): The original post text.
+
+    Returns:
+        tuple: The updated text and a boolean indicating if the post should be sent (False when it contains
+            a mention and mentions are skipped).
+    """
+    spans = []
+    for facet in record.facets or []:
+        feature = facet.features[0]
+        if feature.py_type == LINK_FACET:
+            spans.append((facet.index.byte_start, facet.index.byte_end, feature.uri))
+        elif feature.py_type == MENTION_FACET:
+            if settings.mentions == "skip":
+                return text, False
+            # What a mention is replaced with depends on settings and is worked out by facet_replacement.
+            spans.append((facet.index.byte_start, facet.index.byte_end, feature))
+    spans.sort(key=lambda span: span[0])
+
+    encoded_text = text.encode("UTF-8")
+    pieces = []
+    # Whether the next text starts a new word, and whether the word being read is a hashtag being removed.
+    word_start = True
+    in_hashtag = False
+    position = 0
+    for start, end, replacement in spans + [(len(encoded_text), len(encoded_text), None)]:
+        if start < position or end > len(encoded_text):
+            # Overlapping or out of range facets are left as they are.
+            continue
+        try:
+            plain = encoded_text[position:start].decode("UTF-8")
+        except UnicodeDecodeError:
+            continue
+        if plain:
+            ends_word = plain[-1].isspace()
+            if in_hashtag or "#" in plain:
+                plain, in_hashtag = remove_hashtags(plain, word_start, in_hashtag)
+            word_start = ends_word
+        pieces.append(plain)
+        if replacement is None:
+            break
+        if word_start:
+            in_hashtag = encoded_text.startswith(b"#", start)
+        if not in_hashtag:
+            pieces.append(facet_replacement(encoded_text[start:end], replacement))
+        word_start = False
+        position = end
+    return " ".join("".join(pieces).split()), True
+
+
+def remove_hashtags(text, word_start, in_hashtag):
     """
-    Removes hashtags from the text.
+    Removes the hashtags from a part of the post text between two facets.
 
     Args:
-        text (str): The text containing hashtags.
+        text (str): The part of the post text.
+        word_start (bool): Whether the text starts a new word.
+        in_hashtag (bool): Whether the word the text continues is a hashtag.
 
     Returns:
-        str: Text with hashtags removed.
+        tuple: The text without hashtags, and a boolean indicating if it ends in a hashtag.
     """
-    # Split text into words and filter out hashtags
-    words = text.split()
-    filtered_words = [word for word in words if not word.startswith('#')]
-    return ' '.join(filtered_words)
+    kept = ""
+    if not word_start:
+        # The text right after a facet belongs to the same word, e.g. the closing parenthesis of a link.
+        head = WORD_HEAD_PATTERN.match(text).end()
+        if not in_hashtag:
+            kept = text[:head]
+        text = text[head:]
+        if not text:
+            return kept, in_hashtag
+    kept += HASHTAG_PATTERN.sub("", text)
+    return kept, not text[-1].isspace() and text.rsplit(None, 1)[-1].startswith("#")
 
 
-def get_posts(timelimit=None, deleted_cids=None):
+def facet_replacement(covered, replacement):
+    """
+    Returns the text that replaces the text covered by a facet.
+
+    Args:
+        covered (bytes): The UTF-8 encoded text covered by the facet.
+        replacement: The URI of a link, or the feature of a mention.
+
+    Returns:
+        str: The full URL of a link, or the mention as set in settings.
+    """
+    if isinstance(replacement, str):
+        return replacement
+    if settings.mentions == "url":
+        return f"https://bsky.app/profile/{replacement.did}"
+    covered = covered.decode("UTF-8", errors="ignore")
+    if settings.mentions == "strip":
+        return covered.replace("@", "")
+    return covered
+
+
+def get_posts(timelimit=None, deleted_cids=None, bsky=None, watermark=(None, None)):
     """
     Fetches posts from Bluesky within a specified time limit and processes them for cross-posting.
 
+    The author feed is paged through from the newest post and stops as soon as it reaches posts at or before
+    the watermark, or posts older than the time limit. Paging continues past the watermark as long as any of
+    the recently crossposted posts in deleted_cids have not been found, so they are not wrongly deleted.
+
     Args:
         timelimit (arrow.Arrow, optional): The time limit for fetching posts. Defaults to one hour ago.
         deleted_cids (list, optional): List of post CIDs that have been deleted. Defaults to an empty list.
+        bsky (RateLimitedClient, optional): An already authenticated client to reuse. Defaults to the shared client.
+        watermark (tuple, optional): Timestamp and CID of the newest post handled by a previous run.
 
     Returns:
         tuple: A dictionary of processed posts and a list of deleted CIDs.
@@ -79,120 +201,184 @@ def get_posts(timelimit=None, deleted_cids=None):
     if deleted_cids is None:
         deleted_cids = []
 
-    bsky = bsky_connect()
+    if bsky is None:
+        bsky = bsky_connect()
     logger.info("Gathering posts from Bluesky.")
     posts = {}
+    watermark_time, watermark_cid = watermark
+
+    # Getting feed of user. Replies to other users are never crossposted, so they are filtered out by the server.
+    params = {"actor": BSKY_HANDLE, "filter": FEED_FILTER, "limit": FEED_PAGE_LIMIT}
+    pages = 0
+    while True:
+        profile_feed = bsky.app.bsky.feed.get_author_feed(params)
+        pages += 1
+        oldest = None
+        new_feed_views = []
+        for feed_view in profile_feed.feed:
+            # The feed is ordered by when posts were indexed, and backdated posts can have been created long
+            # before that, so the watermark is compared with the time of indexing.
+            is_repost = hasattr(feed_view.reason, "indexed_at")
+            indexed_at = get_post_indexed_at(feed_view, is_repost)
+            oldest = indexed_at if oldest is None else min(oldest, indexed_at)
+            if watermark_time and (
+                indexed_at < watermark_time
+                or (indexed_at == watermark_time and feed_view.post.cid == watermark_cid)
+            ):
+                # Already handled by a previous run, only checking that it has not been deleted.
+                if feed_view.post.cid in deleted_cids:
+                    deleted_cids.remove(feed_view.post.cid)
+                continue
+            new_feed_views.append(feed_view)
+        fetch_reply_parents(new_feed_views, bsky)
+        for feed_view in new_feed_views:
+            processed = process_feed_view(feed_view, bsky, timelimit, deleted_cids)
+            if processed:
+                cid, post_info = processed
+                posts[cid] = post_info
+        params["cursor"] = profile_feed.cursor
+        if not params["cursor"] or oldest is None or oldest < timelimit:
+            break
+        if watermark_time and oldest <= watermark_time and not deleted_cids:
+            break
+    logger.info(f"Read {pages} page(s) of the author feed, found {len(posts)} new post(s).")
 
-    # Getting feed of user
-    profile_feed = bsky.app.bsky.feed.get_author_feed({"actor": BSKY_HANDLE})
-    visibility_setting = settings.visibility
-
-    for feed_view in profile_feed.feed:
-        # Skip reposts from other accounts
-        if feed_view.post.author.handle != BSKY_HANDLE:
-            continue
+    return posts, deleted_cids
 
-        # Determine if the post is a repost
-        is_repost = hasattr(feed_view.reason, "indexed_at")
-        created_at = get_post_created_at(feed_view, is_repost)
 
-        # Determine if the post should be crossposted based on language settings
-        langs = feed_view.post.record.langs
-        text = feed_view.post.record.text
-        orig_text = text
+def get_watermark(posts, database, watermark=(None, None)):
+    """
+    Determines the feed watermark after a run.
 
-        # Check Twitter ignore tags
-        twitter_post = settings.Twitter and lang_toggle(langs, "twitter")
-        if twitter_post:
-            twitter_post = not check_ignored_tags(text, "twitter")
+    The watermark moves up to the most recently indexed post of the run, unless some posts still have to be
+    retried. In that case it is placed just before the earliest indexed of those posts, so that they are fetched
+    again on the next run. Posts in the outbox are retried from there, so they don't hold the watermark back,
+    and posts that can never be sent are saved as skipped, so they count as handled.
 
-        # Check Mastodon ignore tags
-        mastodon_post = settings.Mastodon and lang_toggle(langs, "mastodon")
-        if mastodon_post:
-            mastodon_post = not check_ignored_tags(text, "mastodon")
+    Args:
+        posts (dict): The posts gathered in the run.
+        database (dict): The database after the posts have been crossposted.
+        watermark (tuple, optional): The watermark used for the run.
 
-        # Remove tags if post will be crossposted
-        if twitter_post or mastodon_post:
-            text = remove_tags(text)
+    Returns:
+        tuple: Timestamp and CID of the new watermark.
+    """
+    if not posts:
+        return watermark
+    unsettled = [
+        post["indexed_at"]
+        for cid, post in posts.items()
+        if (cid not in database or not all(database[cid]["ids"].values())) and cid not in outbox
+    ]
+    if unsettled:
+        return min(unsettled).shift(seconds=-1), ""
+    cid = max(posts, key=lambda cid: posts[cid]["indexed_at"])
+    return posts[cid]["indexed_at"], cid
 
-        if not mastodon_post and not twitter_post:
-            continue
 
-        cid = feed_view.post.cid
+def process_feed_view(feed_view, bsky, timelimit, deleted_cids):
+    """
+    Processes a single feed view into the post info used for cross-posting.
 
-        # Remove ignored tags from text
-        text, has_ignored_tag = remove_ignored_tags(text)
+    Args:
+        feed_view: The feed view object containing the post.
+        bsky: The Bluesky client instance.
+        timelimit (arrow.Arrow): Posts created before this time are not crossposted.
+        deleted_cids (list): List of post CIDs that have been deleted. The CID of the post is removed if present.
 
-        # Skip posts with ignored tags
-        if has_ignored_tag:
-            logger.info(
-                f"Post with CID {cid} contains ignored tags and will not be posted."
-            )
-            continue
+    Returns:
+        tuple: The CID and post info of the post, or None if it should not be crossposted.
+    """
+    # Skip reposts from other accounts
+    if not is_own_account(feed_view.post.author):
+        return None
+
+    # Determine if the post is a repost
+    is_repost = hasattr(feed_view.reason, "indexed_at")
+    created_at = get_post_created_at(feed_view, is_repost)
+
+    # Determine if the post should be crossposted based on language settings
+    langs = feed_view.post.record.langs
+    text = feed_view.post.record.text
+    orig_text = text
+
+    # Check the ignore tags of both platforms
+    ignored = ignored_tags.match(text)
+    twitter_post = settings.Twitter and lang_toggle(langs, "twitter")
+    mastodon_post = settings.Mastodon and lang_toggle(langs, "mastodon")
+    cid = feed_view.post.cid
+    if ignored and (twitter_post or mastodon_post):
+        logger.info(
+            "Post with CID %s contains tags ignored on %s."
+            % (cid, " and ".join(platform.capitalize() for platform in sorted(ignored)))
+        )
+        twitter_post = twitter_post and "twitter" not in ignored
+        mastodon_post = mastodon_post and "mastodon" not in ignored
 
-        # Update deleted_cids if the post is no longer in the timeline
-        if cid in deleted_cids:
-            deleted_cids.remove(cid)
+    if not mastodon_post and not twitter_post:
+        return None
 
-        # Process facets (URLs, mentions)
-        send_mention = True
-        if feed_view.post.record.facets:
-            text = restore_urls(feed_view.post.record, text)
-            text, send_mention = handle_mentions(feed_view.post.record, text)
-        if not send_mention:
-            continue
+    # Restore URLs, handle mentions and remove tags
+    text, send_mention = rewrite_text(feed_view.post.record, text)
 
-        # Handle replies and quotes
-        reply_to_user = BSKY_HANDLE
-        reply_to_post = ""
-        quoted_post = ""
-        quote_url = ""
-        allowed_reply = get_allowed_reply(feed_view.post)
-
-        if is_quote_post(feed_view.post):
-            try:
-                quoted_user, quoted_post, quote_url, is_open = get_quote_post_info(
-                    feed_view.post.embed.record
-                )
-            except Exception as e:
-                logger.error(f"Cannot parse quoted post in CID {cid}: {e}")
-                continue
-            if not should_crosspost_quote(quoted_user, is_open):
-                continue
-            if quoted_user == BSKY_HANDLE:
-                text = text.replace(quote_url, "")
+    # Update deleted_cids if the post is no longer in the timeline
+    if cid in deleted_cids:
+        deleted_cids.remove(cid)
 
-        if feed_view.post.record.reply:
-            reply_to_post = feed_view.post.record.reply.parent.cid
-            reply_to_user = get_reply_to_user(feed_view, bsky)
+    if not send_mention:
+        return None
 
-        if not reply_to_user:
-            logger.info(
-                f"Unable to find the user that post {cid} replies to or quotes."
-            )
-            continue
+    # Handle replies and quotes
+    reply_to_user = BSKY_HANDLE
+    reply_to_post = ""
+    quoted_post = ""
+    quote_url = ""
+    allowed_reply = get_allowed_reply(feed_view.post)
 
-        # Check if the post is within the time limit and not a reply to someone else
-        if created_at > timelimit and reply_to_user == BSKY_HANDLE:
-            media = get_media_info(feed_view)
-            visibility = determine_visibility(visibility_setting, reply_to_post)
-            post_info = create_post_info(
-                text=text,
-                reply_to_post=reply_to_post,
-                quoted_post=quoted_post,
-                quote_url=quote_url,
-                media=media,
-                visibility=visibility,
-                twitter=twitter_post,
-                mastodon=mastodon_post,
-                allowed_reply=allowed_reply,
-                is_repost=is_repost,
-                timestamp=created_at,
+    if is_quote_post(feed_view.post):
+        try:
+            quoted_user, quoted_post, quote_url, is_open = get_quote_post_info(
+                feed_view.post.embed.record
             )
-            logger.debug(f"Processed post info: {post_info}")
-            posts[cid] = post_info
-
-    return posts, deleted_cids
+        except Exception as e:
+            logger.error(f"Cannot parse quoted post in CID {cid}: {e}")
+            return None
+        if not should_crosspost_quote(quoted_user, is_open):
+            return None
+        if quoted_user == BSKY_HANDLE:
+            text = text.replace(quote_url, "")
+
+    if feed_view.post.record.reply:
+        reply_to_post = feed_view.post.record.reply.parent.cid
+        reply_to_user = get_reply_to_user(feed_view, bsky)
+
+    if not reply_to_user:
+        logger.info(
+            f"Unable to find the user that post {cid} replies to or quotes."
+        )
+        return None
+
+    # Check if the post is within the time limit and not a reply to someone else
+    if created_at > timelimit and reply_to_user == BSKY_HANDLE:
+        media = get_media_info(feed_view)
+        visibility = determine_visibility(settings.visibility, reply_to_post)
+        post_info = create_post_info(
+            text=text,
+            reply_to_post=reply_to_post,
+            quoted_post=quoted_post,
+            quote_url=quote_url,
+            media=media,
+            visibility=visibility,
+            twitter=twitter_post,
+            mastodon=mastodon_post,
+            allowed_reply=allowed_reply,
+            is_repost=is_repost,
+            timestamp=created_at,
+            indexed_at=get_post_indexed_at(feed_view, is_repost),
+        )
+        logger.debug(f"Processed post info: {post_info}")
+        return cid, post_info
+    return None
 
 
 def get_post_created_at(feed_view, is_repost):
@@ -213,54 +399,22 @@ def get_post_created_at(feed_view, is_repost):
     return arrow.get(created_at_str, DATE_FORMAT)
 
 
-def remove_ignored_tags(text):
-    """
-    Removes ignored tags from the post text and checks if any were found.
-
-    Args:
-        text (str): The original post text.
-
-    Returns:
-        tuple: Updated text and a boolean indicating if ignored tags were found.
-    """
-    found_ignored_tag = False
-    for tag in settings.ignore_tags_twitter + settings.ignore_tags_mastodon:
-        if tag in text:
-            found_ignored_tag = True
-        text = text.replace(tag, "").strip()
-    return text, found_ignored_tag
-
-
-def handle_mentions(record, text):
+def get_post_indexed_at(feed_view, is_repost):
     """
-    Processes mentions in the post text based on settings.
+    Retrieves the time a post was indexed by Bluesky, which is the order of the author feed.
 
     Args:
-        record: The post record containing facets.
-        text (str): The original post text.
+        feed_view: The feed view object containing the post.
+        is_repost (bool): Indicates if the post is a repost.
 
     Returns:
-        tuple: The updated text and a boolean indicating if the post should be sent.
+        arrow.Arrow: The time the post, or the repost, was indexed.
     """
-    send_mention = True
-    encoded_text = text.encode("UTF-8")
-    for facet in record.facets:
-        if facet.features[0].py_type != "app.bsky.richtext.facet#mention":
-            continue
-        start = facet.index.byte_start
-        end = facet.index.byte_end
-        username = encoded_text[start:end].decode("UTF-8")
-        if settings.mentions == "skip":
-            send_mention = False
-            break
-        elif settings.mentions == "strip":
-            text = text.replace(username, username.replace("@", ""))
-        elif settings.mentions == "url":
-            base_url = "https://bsky.app/profile/"
-            did = facet.features[0].did
-            url = f"{base_url}{did}"
-            text = text.replace(username, url)
-    return text, send_mention
+    if is_repost:
+        indexed_at_str = feed_view.reason.indexed_at.split(".")[0]
+    else:
+        indexed_at_str = feed_view.post.indexed_at.split(".")[0]
+    return arrow.get(indexed_at_str, DATE_FORMAT)
 
 
 def is_quote_post(post):
@@ -368,7 +522,53 @@ def get_reply_to_user(feed_view, bsky):
     try:
         return feed_view.reply.parent.author.handle
     except AttributeError:
-        return bsky.get_reply_to_user(feed_view.post.record.reply.parent)
+        uri = feed_view.post.record.reply.parent.uri
+        if reply_parent_cache.get(uri) is None:
+            fetch_reply_parents([feed_view], bsky)
+        username = reply_parent_cache.get(uri)
+        if not username:
+            logger.info(
+                "Unable to retrieve reply_to-user of post. Probably a reply to a deleted post."
+            )
+        return username or ""
+
+
+def fetch_reply_parents(feed_views, bsky):
+    """
+    Looks up the authors of the posts replied to, for replies where the feed view does not include them.
+
+    Posts are looked up with app.bsky.feed.getPosts, as many at a time as it allows. The handles of the authors
+    are saved in the reply parent cache, or an empty string if the post has been deleted, so that no post is
+    looked up more than once.
+
+    Args:
+        feed_views (list): The feed views of the posts.
+        bsky: The Bluesky client instance.
+    """
+    uris = []
+    for feed_view in feed_views:
+        reply = getattr(feed_view.post.record, "reply", None)
+        if not reply:
+            continue
+        parent = getattr(getattr(feed_view, "reply", None), "parent", None)
+        if getattr(parent, "author", None):
+            continue
+        uri = reply.parent.uri
+        if uri not in uris and reply_parent_cache.get(uri) is None:
+            uris.append(uri)
+    authors = {}
+    for i in range(0, len(uris), GET_POSTS_LIMIT):
+        batch = uris[i : i + GET_POSTS_LIMIT]
+        try:
+            response = bsky.app.bsky.feed.get_posts({"uris": batch})
+        except Exception as e:
+            logger.error(f"Unable to look up posts replied to: {e}")
+            continue
+        found = {post_view.uri: post_view.author.handle for post_view in response.posts}
+        for uri in batch:
+            authors[uri] = found.get(uri, "")
+    if authors:
+        reply_parent_cache.update(authors)
 
 
 def get_media_info(feed_view):
@@ -457,6 +657,7 @@ def create_post_info(**kwargs):
         "allowed_reply": kwargs.get("allowed_reply"),
         "repost": kwargs.get("is_repost"),
         "timestamp": kwargs.get("timestamp"),
+        "indexed_at": kwargs.get("indexed_at"),
     }
 
 
@@ -484,50 +685,91 @@ def get_allowed_reply(post):
     return "Unknown"
 
 
-def restore_urls(record, text):
+def get_video_data(feed_view):
     """
-    Restores shortened URLs in the post text.
+    Retrieves video data from a feed view.
 
     Args:
-        record: The post record containing facets.
-        text (str): The original post text.
+        feed_view: The feed view object containing the post.
 
     Returns:
-        str: The text with URLs restored.
+        dict: A dictionary containing video URL, alt text and the CID of the video blob.
     """
-    encoded_text = text.encode("UTF-8")
-    for facet in record.facets:
-        if facet.features[0].py_type != "app.bsky.richtext.facet#link":
-            continue
-        url = facet.features[0].uri
-        start = facet.index.byte_start
-        end = facet.index.byte_end
-        shortened = encoded_text[start:end].decode("UTF-8")
-        text = text.replace(shortened, url)
-    return text
+    did = feed_view.post.author.did
+    blob_cid = feed_view.post.record.embed.video.ref.link
+    # The video is downloaded from the server hosting the account, instead of being redirected there by bsky.social.
+    pds = resolve_did(did)["pds"] or DEFAULT_PDS
+    url = f"{pds}/xrpc/com.atproto.sync.getBlob?did={did}&cid={blob_cid}"
+    alt = feed_view.post.record.embed.alt or ""
+    return {"url": url, "alt": alt, "cid": blob_cid}
 
 
-def get_video_data(feed_view):
+def resolve_did(did):
     """
-    Retrieves video data from a feed view.
+    Looks up the PDS endpoint and handle of an account from its DID document, using the identity cache.
 
     Args:
-        feed_view: The feed view object containing the post.
+        did (str): The DID of the account.
 
     Returns:
-        dict: A dictionary containing video URL and alt text.
+        dict: The PDS endpoint and handle of the account, which are None if the DID could not be resolved.
     """
-    did = feed_view.post.author.did
-    blob_cid = feed_view.post.record.embed.video.ref.link
-    url = f"https://bsky.social/xrpc/com.atproto.sync.getBlob?did={did}&cid={blob_cid}"
-    alt = feed_view.post.record.embed.alt or ""
-    return {"url": url, "alt": alt}
-
-def check_ignored_tags(text, platform):
-    """Check if text contains any ignored tags for the specified platform"""
-    tags = (settings.ignore_tags_twitter if platform == "twitter"
-            else settings.ignore_tags_mastodon)
-    for tag in tags:
-        if tag in text:
-            return True
-    return False
+    identity = identity_cache.get(did)
+    if identity is not None:
+        return identity
+    identity = {"pds": None, "handle": None}
+    try:
+        did_doc = id_resolver.did.resolve(did)
+    except Exception as e:
+        did_doc = None
+        logger.error(f"Unable to resolve {did}: {e}")
+    if did_doc is None:
+        # Failed lookups are cached for a short while, so that they are not retried for every post.
+        identity_cache.set(did, identity, FAILED_TTL)
+        return identity
+    pds = did_doc.get_pds_endpoint()
+    identity = {"pds": pds.rstrip("/") if pds else None, "handle": did_doc.get_handle()}
+    values = {did: identity}
+    if identity["handle"]:
+        values["handle:" + identity["handle"]] = did
+    identity_cache.update(values)
+    return identity
+
+
+def resolve_handle(handle):
+    """
+    Looks up the DID of a handle, using the identity cache.
+
+    Args:
+        handle (str): The handle of the account.
+
+    Returns:
+        str: The DID of the account, or None if the handle could not be resolved.
+    """
+    did = identity_cache.get("handle:" + handle)
+    if did is not None:
+        return did or None
+    try:
+        did = id_resolver.handle.resolve(handle)
+    except Exception as e:
+        did = None
+        logger.error(f"Unable to resolve {handle}: {e}")
+    identity_cache.set("handle:" + handle, did or "", None if did else FAILED_TTL)
+    return did or None
+
+
+def is_own_account(author):
+    """
+    Checks if an author is the account being crossposted. Accounts are compared by DID, which unlike the
+    handle never changes, falling back to the handle if it can not be resolved.
+
+    Args:
+        author: The author of a post.
+
+    Returns:
+        bool: True if the author is the account being crossposted.
+    """
+    did = resolve_handle(BSKY_HANDLE)
+    if did:
+        return author.did == did
+    return author.handle == BSKY_HANDLE
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import os
+import time
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+import arrow
+import websockets
+from loguru import logger
+from settings import settings
+from settings.paths import jetstream_state_path
+from input.bluesky import GET_POSTS_LIMIT, fetch_reply_parents, process_feed_view
+
+POST_COLLECTION = "app.bsky.feed.post"
+REPOST_COLLECTION = "app.bsky.feed.repost"
+# Jetstream only guarantees ordering per connection, so when reconnecting the cursor is rewound slightly
+# to avoid gaps. Posts that are replayed are already in the database and will not be posted again.
+CURSOR_REWIND_US = 5 * 1000 * 1000
+# How long to wait for more events before handing a batch over, so that threads arrive together.
+BATCH_DELAY = 2
+
+
+def stream_state_read():
+    """
+    Reads the saved stream state.
+
+    Returns:
+        dict: The last processed cursor (in microseconds) and the rkey to CID mapping of recently streamed posts.
+    """
+    state = {"cursor": None, "rkeys": {}}
+    if not os.path.exists(jetstream_state_path):
+        logger.info(jetstream_state_path + " not found.")
+        return state
+    try:
+        with open(jetstream_state_path, "r") as file:
+            state.update(json.load(file))
+    except Exception as e:
+        logger.error(f"Unable to read Jetstream state: {e}")
+    return state
+
+
+def stream_state_write(state):
+    """
+    Saves the stream state, dropping rkeys of posts too old to be cross deleted.
+
+    Args:
+        state (dict): The stream state.
+    """
+    timelimit = arrow.utcnow().shift(hours=-1).timestamp()
+    state["rkeys"] = {
+        rkey: value for rkey, value in state["rkeys"].items() if value[1] > timelimit
+    }
+    with open(jetstream_state_path + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(jetstream_state_path + ".tmp", jetstream_state_path)
+
+
+def build_url(url, did, cursor=None):
+    """
+    Builds the subscription URL, filtered to the posts and reposts of a single account.
+
+    Args:
+        url (str): The Jetstream subscribe endpoint.
+        did (str): The DID of the account.
+        cursor (int, optional): Time in microseconds to resume from.
+
+    Returns:
+        str: The subscription URL.
+    """
+    params = [
+        ("wantedCollections", POST_COLLECTION),
+        ("wantedCollections", REPOST_COLLECTION),
+        ("wantedDids", did),
+    ]
+    if cursor:
+        params.append(("cursor", max(0, int(cursor) - CURSOR_REWIND_US)))
+    return url + ("&" if "?" in url else "?") + urlencode(params)
+
+
+def events_to_posts(events, bsky, timelimit, rkeys, post_cache):
+    """
+    Turns a batch of Jetstream commit events into posts to crosspost and posts to delete.
+
+    Created posts and reposts are hydrated with app.bsky.feed.getPosts, so that they can be processed exactly
+    like the posts in the author feed.
+
+    Args:
+        events (list): Decoded Jetstream events.
+        bsky: The Bluesky client instance.
+        timelimit (arrow.Arrow): Posts created before this time are not crossposted.
+        rkeys (dict): Mapping of rkey to CID and timestamp for recently streamed posts. New posts are added.
+        post_cache (dict): Cache of recently crossposted posts.
+
+    Returns:
+        tuple: A dictionary of processed posts and a list of deleted CIDs.
+    """
+    posts = {}
+    deleted_cids = []
+    # URI of the post to fetch, and the reason (repost) it appeared in the stream, in the order they happened.
+    created = []
+    for event in events:
+        commit = event.get("commit")
+        if event.get("kind") != "commit" or not commit:
+            continue
+        operation = commit.get("operation")
+        collection = commit.get("collection")
+        rkey = commit.get("rkey")
+        if collection == POST_COLLECTION and operation == "create":
+            rkeys[rkey] = [commit.get("cid"), arrow.utcnow().timestamp()]
+            created.append((f"at://{event['did']}/{collection}/{rkey}", None))
+        elif collection == REPOST_COLLECTION and operation == "create":
+            record = commit.get("record", {})
+            reason = SimpleNamespace(indexed_at=record.get("createdAt"))
+            created.append((record.get("subject", {}).get("uri"), reason))
+        elif collection == POST_COLLECTION and operation == "delete":
+            cid = rkeys.pop(rkey, [None])[0]
+            if cid and cid in post_cache:
+                deleted_cids.append(cid)
+
+    uris = list(dict.fromkeys(uri for uri, _ in created if uri))
+    post_views = {}
+    for i in range(0, len(uris), GET_POSTS_LIMIT):
+        response = bsky.app.bsky.feed.get_posts({"uris": uris[i : i + GET_POSTS_LIMIT]})
+        for post_view in response.posts:
+            post_views[post_view.uri] = post_view
+
+    # The author feed lists the newest posts first and post() expects the same order.
+    feed_views = []
+    for uri, reason in reversed(created):
+        if uri not in post_views:
+            logger.info(f"Streamed post {uri} could not be found, probably deleted.")
+            continue
+        feed_views.append(SimpleNamespace(post=post_views[uri], reason=reason, reply=None))
+    # getPosts does not include the posts replied to, so their authors are looked up together.
+    fetch_reply_parents(feed_views, bsky)
+    for feed_view in feed_views:
+        processed = process_feed_view(feed_view, bsky, timelimit, [])
+        if processed:
+            cid, post_info = processed
+            if cid not in deleted_cids:
+                posts[cid] = post_info
+    return posts, deleted_cids
+
+
+async def subscribe(did, handler, url=None, reconnect=True, wakeup=None):
+    """
+    Subscribes to Jetstream and hands batches of events for the account over to the handler.
+
+    The cursor is saved after every batch the handler has processed, so that the subscription resumes
+    without gaps after a restart. If the handler could not process a batch, the connection is closed and
+    the subscription resumes from the saved cursor, so that the batch is received again. While no events
+    arrive, the handler is called with an empty batch at the times given by wakeup.
+
+    Args:
+        did (str): The DID of the account.
+        handler (callable): Called with the events of a batch and the rkey mapping of the stream state.
+            Returns True if the batch was processed. Runs in a separate thread so the connection is kept
+            alive during slow crossposts.
+        url (str, optional): The Jetstream subscribe endpoint. Defaults to jetstream_url in settings.
+        reconnect (bool, optional): Whether to reconnect when the connection is lost. Defaults to True.
+        wakeup (callable, optional): Returns the time (as a Unix timestamp) at which the handler is to be called
+            even if no events have arrived, e.g. to send posts that are due to be retried, or None.
+    """
+    url = url or settings.jetstream_url
+    state = stream_state_read()
+    backoff = 1
+    while True:
+        subscribe_url = build_url(url, did, state["cursor"])
+        logger.info(f"Connecting to Jetstream at {subscribe_url}")
+        try:
+            async with websockets.connect(subscribe_url) as websocket:
+                while True:
+                    due = wakeup() if wakeup else None
+                    timeout = None if due is None else max(due - time.time(), 0)
+                    events = []
+                    try:
+                        events.append(json.loads(await asyncio.wait_for(websocket.recv(), timeout)))
+                        while True:
+                            message = await asyncio.wait_for(websocket.recv(), BATCH_DELAY)
+                            events.append(json.loads(message))
+                    except asyncio.TimeoutError:
+                        pass
+                    try:
+                        processed = await asyncio.get_running_loop().run_in_executor(
+                            None, handler, events, state["rkeys"]
+                        )
+                    except Exception as e:
+                        logger.error(f"Unable to process Jetstream events: {e}")
+                        processed = False
+                    if not events:
+                        # There is nothing to receive again, so the subscription just goes on.
+                        continue
+                    if not processed:
+                        logger.info("Events were not processed, resuming from the last saved cursor.")
+                        if not state["cursor"]:
+                            # Without a saved cursor the subscription would resume from the live stream.
+                            state["cursor"] = min(event.get("time_us", 0) for event in events) or None
+                        break
+                    backoff = 1
+                    state["cursor"] = max(
+                        [state["cursor"] or 0] + [event.get("time_us", 0) for event in events]
+                    )
+                    stream_state_write(state)
+        except websockets.exceptions.ConnectionClosed as e:
+            logger.info(f"Jetstream connection closed: {e}")
+        except OSError as e:
+            logger.error(f"Unable to connect to Jetstream: {e}")
+        if not reconnect:
+            return
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60)
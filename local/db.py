@@ -1,52 +1,49 @@
 from settings.paths import *
+from settings import settings
+from local.db_sqlite import SqliteDatabase, open_database
+from local.db_json import JsonDatabase, Archive, checksum
 from loguru import logger
-import json, os, shutil, arrow
+import glob, gzip, json, os, shutil, sqlite3, arrow
+
+# Number of incremental backups taken on top of a base copy of the database before a new base is taken.
+BACKUP_MAX_DELTAS = 30
+backup_base_path = backup_path + ".base.gz"
+backup_delta_path = backup_path + ".%04d.delta.gz"
+backup_meta_path = backup_path + ".meta"
+sqlite_backup_path = backup_path + ".sqlite"
 
 
 # Function for writing new lines to the database
 def db_write(skeet, tweet, toot, failed, database):
     ids = {"twitter_id": tweet, "mastodon_id": toot}
     data = {"ids": ids, "failed": failed}
-    # When running, the code saves the database to memory, so instead of just saving the post to the database file,
-    # we also save it to the open database. This also overwrites the version of the post in memory in case
-    # an ID that was missing because of a previous failure.
-    database[skeet] = data
-    row = {"skeet": skeet, "ids": ids, "failed": failed}
-    json_string = json.dumps(row)
-    # If the database file exists we want to append to it, otherwise we create it anew.
-    if os.path.exists(database_path):
-        append_write = "a"
-    else:
-        append_write = "w"
-    # Skipping adding posts to db file if they are already in it.
-    if not is_in_db(json_string):
+    # The post is saved to the open database, which also writes it to the database file. This also overwrites
+    # the version of the post in case an ID that was missing because of a previous failure.
+    if isinstance(database, SqliteDatabase):
+        database[skeet] = data
+        logger.info("Adding to database: " + skeet)
+        return database
+    # The JSON database appends the post to the database file, unless it is already in it.
+    json_string = database.write(skeet, data)
+    if json_string:
         logger.info("Adding to database: " + json_string)
-        file = open(database_path, append_write)
-        file.write(json_string + "\n")
-        file.close()
     return database
 
 
-# Function for reading database file and saving values in a dictionary
+# Function for opening the database. Posts are not read here, instead a dictionary-like database is returned
+# which looks posts up in the database file (using its index) or the SQLite database as they are needed.
 def db_read():
-    database = {}
-    if not os.path.exists(database_path):
-        return database
-    with open(database_path, "r") as file:
-        for line in file:
-            try:
-                json_line = json.loads(line)
-            except:
-                continue
-            skeet = json_line["skeet"]
-            ids = json_line["ids"]
-            ids = db_convert(ids)
-            failed = {"twitter": 0, "mastodon": 0}
-            if "failed" in json_line:
-                failed = json_line["failed"]
-            line_data = {"ids": ids, "failed": failed}
-            database[skeet] = line_data
-    return database
+    if settings.database_backend == "sqlite":
+        return open_database(sqlite_database_path, database_path, db_convert, Archive(archive_path))
+    return JsonDatabase(
+        database_path,
+        database_index_path,
+        db_convert,
+        Archive(archive_path),
+        settings.database_hot_days,
+        database_changes_path,
+        database_meta_path,
+    )
 
 
 # After changing from camelCase to snake_case, old database entries will have to be converted.
@@ -63,66 +60,204 @@ def db_convert(ids_in):
     return ids_out
 
 
-# Function for checking if a line is already in the database-file
-def is_in_db(line):
-    if not os.path.exists(database_path):
-        return False
-    with open(database_path, "r") as file:
-        content = file.read()
-        if line in content:
-            return True
+# Posts are written to the database file as they are posted, so at the end of the run only the index
+# of the database file has to be updated. The database file itself is only rewritten when posts have been
+# deleted or it contains too many outdated lines.
+def save_db(database):
+    if isinstance(database, SqliteDatabase):
+        logger.info("Saving new database")
+        database.commit()
+        return
+    if database.save():
+        logger.info("Saved new database")
+    else:
+        logger.info("Database is up to date")
+
+
+# Every 24 hours a backup of the database is saved, in case something happens to the live database.
+# Instead of copying and counting the lines of the whole database file every time, the backup is made of
+# a compressed base copy of the database file and compressed deltas of the changes made since, taken from
+# the changes file the database appends every change to. The number of posts and the checksum of the
+# database are read from the meta file saved along with the database, so nothing has to be counted.
+# If the live database contains fewer posts than the backup it means something has probably gone wrong,
+# and before a new backup is taken, the current backup is saved under new file names, so that it can be
+# recovered later. The database open in the crossposter is passed in, since opening a second instance of
+# the JSON database could rewrite the database file and its index under the open one.
+def db_backup(database=None):
+    if settings.database_backend == "sqlite":
+        sqlite_backup(database)
+        return
+    if not os.path.isfile(database_path):
+        return
+    backup_meta = read_json(backup_meta_path) or {}
+    if "time" in backup_meta and backup_meta["time"] > arrow.utcnow().shift(hours=-24).int_timestamp:
+        return
+    meta = read_json(database_meta_path)
+    if meta is None:
+        if database is None:
+            opened = db_read()
+            opened.save()
+            opened.write_meta()
+            opened.close()
         else:
-            return False
+            database.save()
+            database.write_meta()
+        meta = read_json(database_meta_path)
+    if meta["checksum"] == backup_meta.get("checksum"):
+        logger.info("Database unchanged since last backup")
+        write_json(backup_meta_path, dict(backup_meta, time=arrow.utcnow().int_timestamp))
+        return
+    # Posts moved to the archive are no longer in the database file, so they are counted as well.
+    if meta["rows"] + meta["archived"] < backup_meta.get("rows", 0) + backup_meta.get("archived", 0):
+        date = arrow.utcnow().format("YYMMDD")
+        for file in backup_files():
+            os.rename(file, file + "_" + date)
+        backup_meta = {}
+        logger.error(
+            "Current backup file contains more entries than current live database, backup saved"
+        )
+    deltas = backup_meta.get("deltas", 0)
+    # A new base is taken when posts have been moved to the archive, since that is not in the changes file.
+    if (
+        not os.path.isfile(backup_base_path)
+        or meta["archived"] != backup_meta.get("archived")
+        or deltas >= BACKUP_MAX_DELTAS
+    ):
+        for file in backup_files():
+            os.remove(file)
+        gzip_file(database_path, backup_base_path)
+        deltas = 0
+        logger.info("Backup of database taken")
+    else:
+        deltas += 1
+        gzip_file(database_changes_path, backup_delta_path % deltas)
+        logger.info("Incremental backup of database taken")
+    open(database_changes_path, "w").close()
+    write_json(
+        backup_meta_path,
+        dict(meta, deltas=deltas, time=arrow.utcnow().int_timestamp),
+    )
 
 
-# Since we are working with a version of the database in memory, at the end of the run
-# we completely overwrite the database on file with the one in memory.
-# This does kind of make it uneccessary to write each new post to the file while running,
-# but in case the program fails halfway through it gives us kind of a backup.
-def save_db(database):
-    logger.info("Saving new database")
-    append_write = "w"
-    for skeet in database:
-        row = {
-            "skeet": skeet,
-            "ids": database[skeet]["ids"],
-            "failed": database[skeet]["failed"],
-        }
-        jsonString = json.dumps(row)
-        file = open(database_path, append_write)
-        file.write(jsonString + "\n")
-        file.close()
-        append_write = "a"
-
-
-# Every twelve hours a backup of the database is saved, in case something happens to the live database.
-# If the live database contains fewer lines than the backup it means something has probably gone wrong,
-# and before the live database is saved as a backup, the current backup is saved as a new file, so that
-# it can be recovered later.
-def db_backup():
-    if not os.path.isfile(database_path) or (
-        os.path.isfile(backup_path)
-        and arrow.Arrow.fromtimestamp(os.stat(backup_path).st_mtime)
+# Restores the database file from the backup base and deltas, and checks it against the number of posts
+# and checksum saved with the backup.
+def db_restore():
+    if settings.database_backend == "sqlite":
+        return sqlite_restore()
+    if not os.path.isfile(backup_base_path):
+        logger.error("No backup of database found")
+        return False
+    lines = {}
+    backup_meta = read_json(backup_meta_path) or {}
+    files = [backup_base_path] + [
+        backup_delta_path % i for i in range(1, backup_meta.get("deltas", 0) + 1)
+    ]
+    for path in files:
+        with gzip.open(path, "rt") as file:
+            for line in file:
+                line = line.rstrip("\n")
+                try:
+                    json_line = json.loads(line)
+                except:
+                    continue
+                if json_line.get("deleted"):
+                    lines.pop(json_line["skeet"], None)
+                else:
+                    lines[json_line["skeet"]] = line
+    restored_checksum = "%016x" % checksum(lines.values())
+    if backup_meta and (
+        len(lines) != backup_meta["rows"] or restored_checksum != backup_meta["checksum"]
+    ):
+        logger.warning(
+            "Restored database does not match backup (%s posts, expected %s)"
+            % (len(lines), backup_meta["rows"])
+        )
+    with open(database_path + ".tmp", "w") as file:
+        file.write("".join(line + "\n" for line in lines.values()))
+    # The database file is replaced, so the index is rebuilt the next time it is opened.
+    os.replace(database_path + ".tmp", database_path)
+    open(database_changes_path, "w").close()
+    write_json(
+        database_meta_path,
+        {
+            "rows": len(lines),
+            "archived": Archive(archive_path).entries,
+            "checksum": restored_checksum,
+        },
+    )
+    logger.info("Restored %s posts from %s backup files" % (len(lines), len(files)))
+    return True
+
+
+def backup_files():
+    return [
+        path
+        for path in glob.glob(glob.escape(backup_path) + ".*")
+        if path.endswith(".gz")
+    ]
+
+
+def gzip_file(source, destination):
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    with open(source, "rb") as file, gzip.open(destination + ".tmp", "wb") as compressed:
+        shutil.copyfileobj(file, compressed)
+    os.replace(destination + ".tmp", destination)
+
+
+def read_json(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except Exception as e:
+        logger.error(f"Unable to read {path}: {e}")
+        return None
+
+
+def write_json(path, data):
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+# Same as db_backup, but for the sqlite backend. The backup is taken with SQLite's online backup,
+# and posts are counted with a query instead of by reading the files line by line.
+def sqlite_backup(database=None):
+    if not os.path.isfile(sqlite_database_path) or (
+        os.path.isfile(sqlite_backup_path)
+        and arrow.Arrow.fromtimestamp(os.stat(sqlite_backup_path).st_mtime)
         > arrow.utcnow().shift(hours=-24)
     ):
         return
-    if os.path.isfile(backup_path):
-        if count_lines(backup_path) <= count_lines(database_path):
-            os.remove(backup_path)
-        else:
+    opened = database is None
+    if opened:
+        database = SqliteDatabase(sqlite_database_path)
+    if os.path.isfile(sqlite_backup_path):
+        backup = sqlite3.connect(sqlite_backup_path)
+        backup_rows = backup.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        backup.close()
+        if backup_rows > len(database):
             date = arrow.utcnow().format("YYMMDD")
-            os.rename(backup_path, backup_path + "_" + date)
+            os.rename(sqlite_backup_path, sqlite_backup_path + "_" + date)
             logger.error(
                 "Current backup file contains more entries than current live database, backup saved"
             )
-    shutil.copyfile(database_path, backup_path)
+    database.backup(sqlite_backup_path)
+    if opened:
+        database.connection.close()
     logger.info("Backup of database taken")
 
 
-# Function for counting lines in a file
-def count_lines(file):
-    count = 0
-    with open(file, "r") as file:
-        for count, line in enumerate(file):
-            pass
-    return count
+
+# Same as db_restore, but for the sqlite backend. The backup is a complete copy of the database, so it is
+# copied back into the live database with SQLite's online backup.
+def sqlite_restore():
+    if not os.path.isfile(sqlite_backup_path):
+        logger.error("No backup of database found")
+        return False
+    database = SqliteDatabase(sqlite_database_path)
+    database.restore(sqlite_backup_path)
+    logger.info("Restored %s posts from %s" % (len(database), sqlite_backup_path))
+    database.connection.close()
+    return True
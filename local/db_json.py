@@ -0,0 +1,538 @@
+from collections.abc import MutableMapping
+from loguru import logger
+from collections import OrderedDict
+import arrow, gzip, hashlib, json, mmap, os, struct, threading
+
+
+# The index file starts with a header, followed by one entry per post sorted by the hash of its CID.
+# The header holds the inode and the size of the database file the index was built for, so that an index
+# belonging to an older or restored database file is never used, and lines appended after the index was
+# written can be found. It also counts the lines that have been replaced by newer lines for the same post,
+# and holds the timestamp of the oldest post, which tells when posts are due to be moved to the archive,
+# and the checksum of all posts in the database file.
+INDEX_MAGIC = b"XPIDX003"
+INDEX_HEADER = struct.Struct(">8sQQQQQQ")
+INDEX_ENTRY = struct.Struct(">QQ")
+# The archive index has one entry per archived post, sorted by the hash of its CID, pointing out
+# the month (as YYYYMM) of the archive file the post is in.
+ARCHIVE_MAGIC = b"XPARC001"
+ARCHIVE_HEADER = struct.Struct(">8sQ")
+ARCHIVE_ENTRY = struct.Struct(">QI")
+# Number of archive files kept decompressed in memory.
+ARCHIVE_CACHE_SIZE = 3
+# Share of replaced lines at which the database file is rewritten without them.
+COMPACT_RATIO = 0.25
+
+
+def key_hash(skeet):
+    return int.from_bytes(hashlib.blake2b(skeet.encode(), digest_size=8).digest(), "big")
+
+
+# The checksum of the database is the sum of the hashes of the current line of each post. This does not depend
+# on the order of the lines, so it can be kept up to date as posts are written and deleted, and it can be
+# compared with the checksum of a database rebuilt from backups.
+def line_hash(line):
+    return int.from_bytes(hashlib.blake2b(line.encode(), digest_size=8).digest(), "big")
+
+
+def checksum(lines):
+    return sum(line_hash(line) for line in lines) % 2**64
+
+
+# Finds the first entry for a hash in a memory mapped file of entries sorted by hash.
+def search(mapped, header, entry, count, target):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if entry.unpack_from(mapped, header.size + middle * entry.size)[0] < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# Oldest timestamp of the given lines. Lines from before posts had timestamps count as the oldest possible,
+# so that they are given a timestamp the next time posts are moved to the archive.
+def oldest_timestamp(lines):
+    return min((json.loads(line).get("timestamp", 0) for line in lines), default=None)
+
+
+# Posts older than the hot period are moved out of the database file into gzip compressed archive files,
+# one per month (archive_path/YYYY-MM.jsonl.gz), with an index of which month each archived post is in.
+# The archive is only consulted when a post is not found in the database file.
+class Archive:
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, "archive.idx")
+        self.index = None
+        self.entries = 0
+        self.segments = OrderedDict()
+        self.open()
+
+    def open(self):
+        self.close()
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as file:
+            header = file.read(ARCHIVE_HEADER.size)
+            if len(header) < ARCHIVE_HEADER.size:
+                return
+            magic, self.entries = ARCHIVE_HEADER.unpack(header)
+            if magic != ARCHIVE_MAGIC or not self.entries:
+                self.entries = 0
+                return
+            self.index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+        self.index = None
+
+    def segment_path(self, month):
+        return os.path.join(self.path, "%04d-%02d.jsonl.gz" % (month // 100, month % 100))
+
+    def entry(self, i):
+        return ARCHIVE_ENTRY.unpack_from(self.index, ARCHIVE_HEADER.size + i * ARCHIVE_ENTRY.size)
+
+    # Reads an archive file, returning the latest line for each post in it.
+    def segment(self, month):
+        if month not in self.segments:
+            lines = {}
+            if os.path.exists(self.segment_path(month)):
+                with gzip.open(self.segment_path(month), "rt") as file:
+                    for line in file:
+                        line = line.rstrip("\n")
+                        try:
+                            lines[json.loads(line)["skeet"]] = line
+                        except:
+                            continue
+            self.segments[month] = lines
+            if len(self.segments) > ARCHIVE_CACHE_SIZE:
+                self.segments.popitem(last=False)
+        self.segments.move_to_end(month)
+        return self.segments[month]
+
+    # Returns the month the post was archived in, or None if it is not in the archive. A post that was updated
+    # after it had been archived is archived again in a later month, so the latest month is the current one.
+    def find(self, skeet):
+        if not self.entries:
+            return None
+        target = key_hash(skeet)
+        i = search(self.index, ARCHIVE_HEADER, ARCHIVE_ENTRY, self.entries, target)
+        months = []
+        while i < self.entries:
+            entry_hash, month = self.entry(i)
+            if entry_hash != target:
+                break
+            months.append(month)
+            i += 1
+        for month in reversed(months):
+            if skeet in self.segment(month):
+                return month
+        return None
+
+    def line(self, skeet):
+        month = self.find(skeet)
+        return None if month is None else self.segment(month)[skeet]
+
+    def all_entries(self):
+        return [self.entry(i) for i in range(self.entries)]
+
+    def write_index(self, entries):
+        os.makedirs(self.path, exist_ok=True)
+        self.close()
+        with open(self.index_path + ".tmp", "wb") as file:
+            file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, len(entries)))
+            file.write(b"".join(ARCHIVE_ENTRY.pack(*entry) for entry in entries))
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.open()
+
+    # Adds lines, given as skeet: (line, timestamp), to the archive files of their months. Each batch is added
+    # to the end of the archive file as a new gzip member, so the existing archive is never rewritten.
+    def add(self, lines):
+        os.makedirs(self.path, exist_ok=True)
+        months = {}
+        for skeet, (line, timestamp) in lines.items():
+            month = int(arrow.get(timestamp).format("YYYYMM"))
+            months.setdefault(month, []).append(line + "\n")
+        for month, month_lines in months.items():
+            with gzip.open(self.segment_path(month), "at") as file:
+                file.writelines(month_lines)
+            self.segments.pop(month, None)
+        new_entries = [
+            (key_hash(skeet), int(arrow.get(timestamp).format("YYYYMM")))
+            for skeet, (_, timestamp) in lines.items()
+        ]
+        self.write_index(sorted(set(self.all_entries() + new_entries)))
+        logger.info("Moved %s posts to the archive" % len(lines))
+
+    # Removes a post from the archive by writing its archive files anew, including the files of earlier months
+    # it was archived in before it was updated.
+    def remove(self, skeet):
+        month = self.find(skeet)
+        while month is not None:
+            self.remove_from(skeet, month)
+            month = self.find(skeet)
+
+    def remove_from(self, skeet, month):
+        lines = dict(self.segment(month))
+        del lines[skeet]
+        target = key_hash(skeet)
+        with gzip.open(self.segment_path(month) + ".tmp", "wt") as file:
+            file.writelines(line + "\n" for line in lines.values())
+        os.replace(self.segment_path(month) + ".tmp", self.segment_path(month))
+        self.segments.pop(month, None)
+        # Another post in the same month could share the hash, in which case the entry is still needed.
+        if not any(key_hash(other) == target for other in lines):
+            self.write_index([entry for entry in self.all_entries() if entry != (target, month)])
+
+    # All lines in the archive, from the oldest month to the newest.
+    def lines(self):
+        for month in sorted({month for _, month in self.all_entries()}):
+            yield from self.segment(month).values()
+
+    def __iter__(self):
+        months = sorted({month for _, month in self.all_entries()})
+        seen = set()
+        for month in months:
+            for skeet in list(self.segment(month)):
+                if skeet not in seen:
+                    seen.add(skeet)
+                    yield skeet
+
+
+# The JSON database, behaving like a dictionary of posts. Instead of reading the whole database file on
+# every run, the file is memory mapped, and an index of CID to byte offset kept next to it is used to find
+# and decode only the posts that are actually looked up. Posts that are written are appended to the file
+# right away and kept in memory until the index is updated by save(). With an archive and a number of
+# hot days set, posts older than that are moved from the database file to the archive when saving.
+class JsonDatabase(MutableMapping):
+    def __init__(
+        self, path, index_path, convert, archive=None, hot_days=0, changes_path=None, meta_path=None
+    ):
+        self.path = path
+        self.index_path = index_path
+        self.convert = convert
+        # Every change is also added to the changes file, which is used for incremental backups,
+        # and the number of posts and the checksum are saved to the meta file.
+        self.changes_path = changes_path
+        self.meta_path = meta_path
+        self.archive = archive
+        self.hot_days = hot_days
+        self.lock = threading.RLock()
+        self.data = self.index = None
+        self.open()
+
+    def open(self):
+        self.close()
+        # Lines appended since the index was written, as skeet: (line, offset)
+        self.changes = {}
+        self.deleted = set()
+        self.cache = {}
+        self.entries = 0
+        self.dead = 0
+        self.oldest = arrow.utcnow().int_timestamp
+        self.checksum = 0
+        if not os.path.exists(self.path):
+            return
+        stat = os.stat(self.path)
+        if stat.st_size:
+            with open(self.path, "rb") as file:
+                self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.read_index_header()
+        if not header or header[1] != stat.st_ino or header[2] > stat.st_size:
+            logger.info("Building database index")
+            lines = self.scan(0)
+            oldest = oldest_timestamp(line for line, _ in lines.values())
+            self.checksum = checksum(line for line, _ in lines.values())
+            self.write_index(lines, stat.st_size, 0, self.oldest if oldest is None else oldest)
+            header = self.read_index_header()
+        _, _, covered, self.entries, self.dead, self.oldest, self.checksum = header
+        if self.entries:
+            with open(self.index_path, "rb") as file:
+                self.index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Picking up lines that were appended after the index was last written.
+        for skeet, (line, offset) in self.scan(covered).items():
+            found = self.find(skeet)
+            if found:
+                self.dead += 1
+                self.checksum -= line_hash(found[0])
+            self.checksum = (self.checksum + line_hash(line)) % 2**64
+            self.changes[skeet] = (line, offset)
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if mapped is not None:
+                mapped.close()
+        self.data = self.index = None
+
+    # Reads the database file from the given offset and returns the latest line for each post.
+    def scan(self, start):
+        lines = {}
+        if self.data is None:
+            return lines
+        offset = start
+        while offset < len(self.data):
+            end = self.data.find(b"\n", offset)
+            if end == -1:
+                end = len(self.data)
+            line = self.data[offset:end].decode()
+            try:
+                lines[json.loads(line)["skeet"]] = (line, offset)
+            except:
+                pass
+            offset = end + 1
+        return lines
+
+    def read_index_header(self):
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, "rb") as file:
+            header = file.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            return None
+        header = INDEX_HEADER.unpack(header)
+        if header[0] != INDEX_MAGIC:
+            return None
+        return header
+
+    # Writes the index for the lines given as skeet: (line, offset), covering the database file up to size.
+    def write_index(self, lines, size, dead, oldest):
+        entries = sorted((key_hash(skeet), offset) for skeet, (_, offset) in lines.items())
+        self.write_index_entries(entries, size, dead, oldest)
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+    def read_line(self, offset):
+        end = self.data.find(b"\n", offset)
+        return self.data[offset : end if end != -1 else len(self.data)].decode()
+
+    # Finds the line of a post in the indexed part of the database file with a binary search of the index.
+    # Returns the line and its offset, or None if the post is not in the index.
+    def find(self, skeet):
+        if not self.entries:
+            return None
+        target = key_hash(skeet)
+        low = search(self.index, INDEX_HEADER, INDEX_ENTRY, self.entries, target)
+        while low < self.entries:
+            entry_hash, offset = self.entry(low)
+            if entry_hash != target:
+                break
+            line = self.read_line(offset)
+            if json.loads(line)["skeet"] == skeet:
+                return line, offset
+            low += 1
+        return None
+
+    # Returns the current line of a post in the database file, or None if it does not exist.
+    def line(self, skeet):
+        with self.lock:
+            if skeet in self.deleted:
+                return None
+            if skeet in self.changes:
+                return self.changes[skeet][0]
+            found = self.find(skeet)
+            return found[0] if found else None
+
+    def __getitem__(self, skeet):
+        with self.lock:
+            if skeet not in self.cache:
+                line = self.line(skeet)
+                if line is None and skeet not in self.deleted and self.archive:
+                    line = self.archive.line(skeet)
+                if line is None:
+                    raise KeyError(skeet)
+                json_line = json.loads(line)
+                failed = {"twitter": 0, "mastodon": 0}
+                if "failed" in json_line:
+                    failed = json_line["failed"]
+                self.cache[skeet] = {"ids": self.convert(json_line["ids"]), "failed": failed}
+            return self.cache[skeet]
+
+    def __setitem__(self, skeet, data):
+        self.write(skeet, data)
+
+    # Saves a post, appending it to the database file unless the line in the file is already the same.
+    # The post keeps the timestamp of when it was first saved. Returns the line if it was appended.
+    def write(self, skeet, data):
+        with self.lock:
+            current = self.line(skeet)
+            timestamp = None
+            if current is not None:
+                timestamp = json.loads(current).get("timestamp")
+            row = {
+                "skeet": skeet,
+                "ids": data["ids"],
+                "failed": data["failed"],
+                "timestamp": timestamp or arrow.utcnow().int_timestamp,
+            }
+            json_string = json.dumps(row)
+            self.cache[skeet] = data
+            if current == json_string:
+                return None
+            if current is not None:
+                self.dead += 1
+                self.checksum -= line_hash(current)
+            self.checksum = (self.checksum + line_hash(json_string)) % 2**64
+            with open(self.path, "ab") as file:
+                offset = file.tell()
+                file.write(json_string.encode() + b"\n")
+            self.log_change(json_string)
+            self.changes[skeet] = (json_string, offset)
+            self.deleted.discard(skeet)
+            return json_string
+
+    def __delitem__(self, skeet):
+        with self.lock:
+            if skeet not in self:
+                raise KeyError(skeet)
+            self.cache.pop(skeet, None)
+            line = self.line(skeet)
+            if line is None:
+                self.archive.remove(skeet)
+                return
+            self.checksum = (self.checksum - line_hash(line)) % 2**64
+            self.changes.pop(skeet, None)
+            self.deleted.add(skeet)
+
+    def __contains__(self, skeet):
+        with self.lock:
+            if self.line(skeet) is not None:
+                return True
+            return bool(self.archive) and skeet not in self.deleted and self.archive.find(skeet) is not None
+
+    # Lines of the indexed part of the file that are still current, as (hash, offset), in file order.
+    def current_entries(self):
+        replaced = {key_hash(skeet) for skeet in self.deleted | set(self.changes)}
+        entries = []
+        for i in range(self.entries):
+            entry_hash, offset = self.entry(i)
+            if entry_hash in replaced:
+                skeet = json.loads(self.read_line(offset))["skeet"]
+                if skeet in self.deleted or skeet in self.changes:
+                    continue
+            entries.append((entry_hash, offset))
+        entries.sort(key=lambda entry: entry[1])
+        return entries
+
+    def __iter__(self):
+        with self.lock:
+            skeets = [
+                json.loads(self.read_line(offset))["skeet"]
+                for _, offset in self.current_entries()
+            ] + list(self.changes)
+            if self.archive:
+                hot = set(skeets) | self.deleted
+                skeets += [skeet for skeet in self.archive if skeet not in hot]
+        return iter(skeets)
+
+    def __len__(self):
+        with self.lock:
+            if self.archive and self.archive.entries:
+                return sum(1 for _ in self)
+            indexed = sum(1 for skeet in self.deleted | set(self.changes) if self.find(skeet))
+            return self.entries - indexed + len(self.changes)
+
+    # Updates the index with the posts written since it was last saved. Deleted posts, or too many replaced
+    # lines, are removed by writing the database file anew in one go to a temporary file, which then
+    # replaces the database, so that the database is never left half written. The same happens when the
+    # oldest post is older than the hot period, in which case the older posts are moved to the archive.
+    def save(self):
+        with self.lock:
+            cutoff = arrow.utcnow().shift(days=-self.hot_days).int_timestamp
+            archive = bool(self.archive) and self.hot_days > 0 and self.oldest < cutoff
+            if not self.changes and not self.deleted and not archive:
+                return False
+            for skeet in self.deleted:
+                self.log_change(json.dumps({"skeet": skeet, "deleted": True}))
+            if not archive and not self.deleted and self.dead <= COMPACT_RATIO * (
+                self.entries + len(self.changes)
+            ):
+                entries = sorted(
+                    self.current_entries()
+                    + [(key_hash(skeet), offset) for skeet, (_, offset) in self.changes.items()]
+                )
+                oldest = oldest_timestamp(line for line, _ in self.changes.values())
+                self.write_index_entries(
+                    entries, os.path.getsize(self.path), self.dead, min(self.oldest, oldest)
+                )
+            else:
+                self.rewrite(cutoff if archive else None)
+            self.open()
+            self.write_meta()
+            return True
+
+    # Writes the database file anew with only the current lines. If a cutoff is given, posts from before it
+    # are moved to the archive, and posts without a timestamp are given the current time.
+    def rewrite(self, cutoff=None):
+        logger.info("Compacting database file")
+        lines = [
+            (entry_hash, self.read_line(offset)) for entry_hash, offset in self.current_entries()
+        ] + [(key_hash(skeet), line) for skeet, (line, _) in self.changes.items()]
+        oldest = self.oldest
+        if cutoff is not None:
+            now = arrow.utcnow().int_timestamp
+            kept = []
+            archived = {}
+            for entry_hash, line in lines:
+                row = json.loads(line)
+                if "timestamp" not in row:
+                    row["timestamp"] = now
+                    line = json.dumps(row)
+                if row["timestamp"] < cutoff:
+                    archived[row["skeet"]] = (line, row["timestamp"])
+                else:
+                    kept.append((entry_hash, line))
+            if archived:
+                self.archive.add(archived)
+            lines = kept
+            self.checksum = checksum(line for _, line in lines)
+            oldest = oldest_timestamp(line for _, line in lines)
+            if oldest is None:
+                oldest = now
+        chunks = []
+        entries = []
+        position = 0
+        for entry_hash, line in lines:
+            line = line.encode() + b"\n"
+            entries.append((entry_hash, position))
+            chunks.append(line)
+            position += len(line)
+        self.close()
+        with open(self.path + ".tmp", "wb") as file:
+            file.write(b"".join(chunks))
+        os.replace(self.path + ".tmp", self.path)
+        self.write_index_entries(sorted(entries), position, 0, oldest)
+
+    def write_index_entries(self, entries, size, dead, oldest):
+        inode = os.stat(self.path).st_ino
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        with open(self.index_path + ".tmp", "wb") as file:
+            file.write(
+                INDEX_HEADER.pack(
+                    INDEX_MAGIC, inode, size, len(entries), dead, oldest, self.checksum
+                )
+            )
+            file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def log_change(self, line):
+        if self.changes_path:
+            with open(self.changes_path, "a") as file:
+                file.write(line + "\n")
+
+    # Saves the number of posts and the checksum of the database file, and the number of archived posts.
+    def write_meta(self):
+        if not self.meta_path:
+            return
+        meta = {
+            "rows": self.entries,
+            "archived": self.archive.entries if self.archive else 0,
+            "checksum": "%016x" % self.checksum,
+        }
+        with open(self.meta_path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
@@ -0,0 +1,143 @@
+from collections.abc import MutableMapping
+from loguru import logger
+import itertools, json, os, sqlite3, threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    skeet TEXT PRIMARY KEY,
+    twitter_id,
+    mastodon_id,
+    twitter_failed INTEGER NOT NULL DEFAULT 0,
+    mastodon_failed INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS posts_twitter_id ON posts (twitter_id);
+CREATE INDEX IF NOT EXISTS posts_mastodon_id ON posts (mastodon_id);
+"""
+
+
+# Database backed by SQLite, which behaves like the dictionary returned by db_read for the JSON database,
+# but only reads the posts that are actually looked up. The ID columns have no declared type, so IDs are
+# returned with the same type they were saved with, just like in the JSON database.
+class SqliteDatabase(MutableMapping):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def __getitem__(self, skeet):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT twitter_id, mastodon_id, twitter_failed, mastodon_failed FROM posts WHERE skeet = ?",
+                (skeet,),
+            ).fetchone()
+        if row is None:
+            raise KeyError(skeet)
+        return to_data(row)
+
+    def __setitem__(self, skeet, data):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)", to_row(skeet, data)
+            )
+
+    def __delitem__(self, skeet):
+        with self.lock, self.connection:
+            cursor = self.connection.execute("DELETE FROM posts WHERE skeet = ?", (skeet,))
+        if not cursor.rowcount:
+            raise KeyError(skeet)
+
+    def __contains__(self, skeet):
+        with self.lock:
+            return (
+                self.connection.execute(
+                    "SELECT 1 FROM posts WHERE skeet = ?", (skeet,)
+                ).fetchone()
+                is not None
+            )
+
+    def __iter__(self):
+        with self.lock:
+            skeets = self.connection.execute("SELECT skeet FROM posts").fetchall()
+        return (skeet for (skeet,) in skeets)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+    # Imports rows from a database file in the JSON lines format, and from the archive of posts moved out of
+    # it. Later rows for the same post replace earlier ones, the same way they do when reading the JSON
+    # database, so archived posts are imported first, from the oldest month to the newest.
+    def import_jsonl(self, path, convert, archive=None):
+        rows = []
+        lines = archive.lines() if archive else []
+        if os.path.exists(path):
+            lines = itertools.chain(lines, open_lines(path))
+        for line in lines:
+            try:
+                json_line = json.loads(line)
+            except:
+                continue
+            failed = json_line.get("failed", {"twitter": 0, "mastodon": 0})
+            data = {"ids": convert(json_line["ids"]), "failed": failed}
+            rows.append(to_row(json_line["skeet"], data))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)", rows
+            )
+        source = path + (" and its archive" if archive and archive.entries else "")
+        logger.info("Imported %s rows from %s" % (len(rows), source))
+
+    def backup(self, path):
+        destination = sqlite3.connect(path)
+        with self.lock:
+            self.connection.backup(destination)
+        destination.close()
+
+    # Replaces all posts with the posts in a backup taken by backup().
+    def restore(self, path):
+        source = sqlite3.connect(path)
+        with self.lock:
+            source.backup(self.connection)
+        source.close()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+
+def to_row(skeet, data):
+    return (
+        skeet,
+        data["ids"]["twitter_id"],
+        data["ids"]["mastodon_id"],
+        data["failed"]["twitter"],
+        data["failed"]["mastodon"],
+    )
+
+
+def to_data(row):
+    return {
+        "ids": {"twitter_id": row[0], "mastodon_id": row[1]},
+        "failed": {"twitter": row[2], "mastodon": row[3]},
+    }
+
+
+def open_lines(path):
+    with open(path, "r") as file:
+        yield from file
+
+
+# Opens the SQLite database. The first time it is opened, any existing JSON database is imported into it,
+# along with the posts in its archive. The import is done to a temporary file, so that an interrupted import
+# is started over on the next run.
+def open_database(path, jsonl_path, convert, archive=None):
+    if not os.path.exists(path) and (os.path.exists(jsonl_path) or (archive and archive.entries)):
+        logger.info("Importing %s into SQLite database %s" % (jsonl_path, path))
+        importing = SqliteDatabase(path + ".tmp")
+        importing.import_jsonl(jsonl_path, convert, archive)
+        importing.connection.close()
+        os.replace(path + ".tmp", path)
+    return SqliteDatabase(path)
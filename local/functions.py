@@ -1,10 +1,12 @@
-from atproto import Client, Session, SessionEvent
+from atproto import Client, Session, SessionEvent, models
+from atproto.exceptions import BadRequestError, RequestErrorBase, UnauthorizedError
 from loguru import logger
 from settings.auth import *
 from settings.paths import *
 from local.functions import *
 from settings import settings
-import os, shutil, re, arrow, sys
+from local.ratelimit import limiter
+import os, json, threading, arrow, sys
 
 
 # Setting up logging
@@ -19,30 +21,72 @@ logger.add(
 )
 
 
-# A wrapper class for the atproto client that allows us to get ratelimit info
+# A wrapper class for the atproto client that allows us to get ratelimit info. It also keeps the session
+# alive by itself and saves it to the session cache only when the tokens have changed.
 class RateLimitedClient(Client):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
         self._limit = self._remaining = self._reset = None
+        self._saved_session = None
+        # atproto only accepts plain functions as callbacks, bound methods are silently ignored.
+        self.on_session_change(lambda event, session: self._session_changed(event, session))
+
+    def _session_changed(self, event: SessionEvent, session: Session) -> None:
+        exported = session.export()
+        if exported == self._saved_session:
+            return
+        # An imported session is the one already in the session cache.
+        if event != SessionEvent.IMPORT:
+            logger.info("Bluesky session %s, saving new tokens." % event.value)
+            session_cache_write(exported)
+        self._saved_session = exported
+
+    # A refresh token that has expired or been revoked can't be refreshed, so a new session is created
+    # with the password instead of failing the run.
+    def _refresh_and_set_session(self):
+        try:
+            return super()._refresh_and_set_session()
+        except (BadRequestError, UnauthorizedError) as e:
+            error = getattr(e.response.content, "error", None) if e.response else None
+            if error not in ("ExpiredToken", "InvalidToken"):
+                raise
+            logger.info("Unable to refresh Bluesky session (%s), logging in again." % error)
+            # This runs while the client holds the lock it takes before every request, so the login is sent
+            # the same way as the refresh, without taking the lock again.
+            session = self.com.atproto.server.create_session(
+                models.ComAtprotoServerCreateSession.Data(identifier=BSKY_HANDLE, password=BSKY_PASSWORD),
+                session_refreshing=True,
+            )
+            self._set_session(SessionEvent.CREATE, session)
+            return session
 
     def get_rate_limit(self):
         return self._limit, self._remaining, self._reset
 
+    # Every response is handed to the rate limiter, including errors, so that a RateLimitExceeded error
+    # pauses the crossposter until the limit resets.
     def _invoke(self, *args, **kwargs):
-        self.response = super()._invoke(*args, **kwargs)
+        url = kwargs.get("url", "")
+        try:
+            self.response = super()._invoke(*args, **kwargs)
+        except RequestErrorBase as e:
+            if e.response is not None:
+                limiter.record("bluesky", url, e.response.headers)
+            raise
         logger.debug(self.response)
-        if not self.response.headers.get("RateLimit-Limit"):
+        limiter.record("bluesky", url, self.response.headers)
+        # atproto lowercases the names of the headers.
+        if not self.response.headers.get("ratelimit-limit"):
             return self.response
-        self._limit = self.response.headers.get("RateLimit-Limit")
-        self._remaining = self.response.headers.get("RateLimit-Remaining")
-        self._reset = self.response.headers.get("RateLimit-Reset")
-        if (int(self._remaining) / int(self._limit)) * 100 < settings.rate_limit_buffer:
+        self._limit = int(self.response.headers.get("ratelimit-limit"))
+        self._remaining = int(self.response.headers.get("ratelimit-remaining"))
+        self._reset = int(self.response.headers.get("ratelimit-reset"))
+        if (self._remaining / self._limit) * 100 < settings.rate_limit_buffer:
             logger.info(
                 "Rate limit buffer reached, after this run poster will pause until %s"
                 % arrow.Arrow.fromtimestamp(self._reset).format("YYYY-MM-DD HH:mm:ss")
             )
-            rate_limit_write(self._reset)
         else:
             logger.info(
                 "Bluesky rate limit has %s out of %s remaining."
@@ -51,25 +95,6 @@ class RateLimitedClient(Client):
 
         return self.response
 
-    def get_reply_to_user(self, reply):
-        uri = reply.uri
-        username = ""
-        try:
-            response = self.app.bsky.feed.get_post_thread(params={"uri": uri})
-            username = response.thread.post.author.handle
-        except Exception as e:
-            logger.info(
-                "Unable to retrieve reply_to-user of post. Probably a reply to a deleted post."
-            )
-        return username
-
-
-def on_session_change(event: SessionEvent, session: Session) -> None:
-    print("Session changed:", event, repr(session))
-    if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
-        print("Saving changed session")
-        session_cache_write(session.export())
-
 
 def session_cache_read():
     logger.info("Reading session cache")
@@ -82,33 +107,22 @@ def session_cache_read():
 
 def session_cache_write(session):
     logger.info("Saving session cache")
-    with open(session_cache_path, "w") as file:
+    with open(session_cache_path + ".tmp", "w") as file:
         file.write(session)
+    os.replace(session_cache_path + ".tmp", session_cache_path)
 
 
-# Functions for checking and saving ratelimit-reset
+# Checks if the Bluesky rate limit buffer was reached, by this or an earlier run, and has not reset yet.
 def check_rate_limit():
     logger.info("Checking if application has reach rate limit buffer limit.")
-    if not os.path.exists(rate_limit_path):
+    reset = limiter.blocked_until("bluesky", settings.rate_limit_buffer)
+    if reset is None:
         return False
-    with open(rate_limit_path, "r") as file:
-        timestamp = arrow.Arrow.fromtimestamp(file.read())
-        if timestamp > arrow.now():
-            logger.info(
-                "Rate limit buffer reached, will resume posting %s"
-                % timestamp.humanize()
-            )
-            return True
-        else:
-            os.remove(rate_limit_path)
-            return False
-
-
-def rate_limit_write(ratelimit_reset):
-    logger.info("Saving ratelimit-reset time")
-    file = open(rate_limit_path, "w")
-    file.write(ratelimit_reset)
-    file.close()
+    logger.info(
+        "Rate limit buffer reached, will resume posting %s"
+        % arrow.Arrow.fromtimestamp(reset).humanize()
+    )
+    return True
 
 
 # This function uses the language selection as a way to select which posts should be crossposted.
@@ -128,35 +142,50 @@ def lang_toggle(langs, service):
         return settings.post_default
 
 
-# Function for correctly counting post length
-def post_length(post):
-    # Twitter shortens urls to 23 characters
-    short_url_length = 23
-    length = len(post)
-    # Finding all urls and calculating how much shorter the post will be after shortening
-    regex = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-    urls = re.findall(regex, post)
-    for url in urls:
-        url_length = len(url[0])
-        if url_length > short_url_length:
-            length = length - (url_length - short_url_length)
-    return length
+# Finds a file in the media cache. Downloaded media is saved in image_path, named after the CID of the
+# blob on Bluesky, so that retries and reposts use the file that is already there instead of downloading it again.
+# Returns the path of the file, or None if it is not in the cache.
+def media_cache_find(key):
+    if not os.path.isdir(image_path):
+        return None
+    for filename in os.listdir(image_path):
+        if filename.split(".")[0] == key and not filename.endswith(".part"):
+            file_path = os.path.join(image_path, filename)
+            # The modification time is used as the time the file was last used, when the cache is cleaned up.
+            os.utime(file_path)
+            return file_path
+    return None
 
 
-# Cleaning up downloaded images
+# Cleaning up the media cache. Files that have not been used for media_cache_days are deleted, and after that
+# the least recently used files are deleted until the cache is no larger than media_cache_size.
 def cleanup():
-    logger.info("Deleting local images")
+    if not os.path.isdir(image_path):
+        return
+    files = []
     for filename in os.listdir(image_path):
         if filename == ".gitignore":
             continue
         file_path = os.path.join(image_path, filename)
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            files.append((stat.st_mtime, stat.st_size, file_path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    timelimit = arrow.utcnow().shift(days=-settings.media_cache_days).timestamp()
+    max_size = settings.media_cache_size * 1024 * 1024
+    deleted = 0
+    for mtime, size, file_path in files:
+        if mtime >= timelimit and total <= max_size:
+            break
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
+            os.unlink(file_path)
+            total -= size
+            deleted += 1
         except Exception as e:
             logger.error("Failed to delete %s. Reason: %s" % (file_path, e))
+    if deleted:
+        logger.info("Deleted %s files from media cache" % deleted)
 
 
 # Following two functions deals with the post per hour limit
@@ -184,6 +213,13 @@ def post_cache_read():
     return cache
 
 
+# When running as a daemon the cache is kept in memory between runs, so posts older than an hour
+# are dropped here instead of when reading the cache file.
+def post_cache_prune(cache):
+    timelimit = arrow.utcnow().shift(hours=-1)
+    return {post_id: timestamp for post_id, timestamp in cache.items() if timestamp > timelimit}
+
+
 def post_cache_write(cache):
     logger.info("Saving post cache.")
     if not cache and os.path.exists(post_cache_path):
@@ -199,6 +235,28 @@ def post_cache_write(cache):
         append_write = "a"
 
 
+# Functions for reading and saving the high-water mark of the author feed. The mark is saved as the
+# timestamp and CID of the newest post that has been fully handled, in the same format as the post cache.
+def feed_watermark_read():
+    if not os.path.exists(feed_watermark_path):
+        return None, None
+    with open(feed_watermark_path, "r") as file:
+        try:
+            cid, timestamp = file.read().strip().split(";")
+            return arrow.Arrow.fromtimestamp(int(timestamp.split(".")[0])), cid
+        except Exception as e:
+            logger.error(e)
+            return None, None
+
+
+def feed_watermark_write(timestamp, cid):
+    if timestamp is None:
+        return
+    logger.info("Saving feed watermark.")
+    with open(feed_watermark_path, "w") as file:
+        file.write((cid or "") + ";" + str(timestamp.timestamp()) + "\n")
+
+
 # The timelimit specifies the cutoff time for which posts are crossposted. This is usually based on the
 # post_time_limit in settings, but if overflow_posts is set to "skip", meaning any posts that could
 # not be posted due to the hourly post max limit is to be skipped, then the timelimit is instead set to
@@ -211,3 +269,53 @@ def get_post_time_limit(cache):
         if timelimit < cache[post_id]:
             timelimit = cache[post_id]
     return timelimit
+
+
+# A cache of values that expire after a while, saved as JSON to a file so that it is kept between runs.
+# Used for things that rarely change but are slow to look up, like the DID documents of Bluesky users.
+class PersistentCache:
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = None
+
+    def load(self):
+        if self.values is not None:
+            return
+        self.values = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                self.values = json.load(file)
+        except Exception as e:
+            logger.error(f"Unable to read {self.path}: {e}")
+
+    def get(self, key):
+        with self.lock:
+            self.load()
+            if key not in self.values:
+                return None
+            value, expires = self.values[key]
+            if expires < arrow.utcnow().timestamp():
+                return None
+            return value
+
+    # Saves values given as a dictionary, expiring after ttl seconds or the ttl of the cache.
+    def update(self, values, ttl=None):
+        with self.lock:
+            self.load()
+            now = arrow.utcnow().timestamp()
+            expires = now + (ttl or self.ttl)
+            self.values = {
+                key: value for key, value in self.values.items() if value[1] > now
+            }
+            for key, value in values.items():
+                self.values[key] = [value, expires]
+            with open(self.path + ".tmp", "w") as file:
+                json.dump(self.values, file)
+            os.replace(self.path + ".tmp", self.path)
+
+    def set(self, key, value, ttl=None):
+        self.update({key: value}, ttl)
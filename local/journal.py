@@ -0,0 +1,108 @@
+from settings.paths import publish_journal_path
+import json, os, threading, arrow
+
+# How long attempts whose outcome is unknown are kept in the journal.
+JOURNAL_DAYS = 1
+
+
+# Write-ahead journal of posts being sent. An attempt is written to the journal, and flushed to disk, before the
+# post is sent, and its outcome is written as soon as the platform has answered. If the crossposter stops in
+# between, the journal shows which posts may have been sent without being saved to the database, so they can be
+# reconciled the next time it starts instead of being sent again.
+class PublishJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, entry):
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+    # Records that a post is about to be sent to a platform, and returns the idempotency key of the attempt.
+    # The key is the same for every attempt at sending the same post, so a platform that supports
+    # idempotency keys recognizes a retry of an attempt that was interrupted.
+    # The progress of a thread that was partly sent by an earlier attempt is carried over as sent.
+    def begin(self, cid, platform, post, sent=None):
+        key = idempotency_key(cid, platform)
+        entry = {
+            "key": key,
+            "cid": cid,
+            "platform": platform,
+            "state": "started",
+            "time": arrow.utcnow().timestamp(),
+            "text": post["text"],
+        }
+        if sent:
+            entry["sent"] = sent
+        self.append(entry)
+        return key
+
+    # Records the parts of a thread that have been sent so far, so that a later attempt can resume it.
+    def progress(self, key, sent):
+        self.append({"key": key, "sent": sent})
+
+    def finish(self, key, post_id):
+        self.append({"key": key, "state": "done", "id": post_id})
+
+    def fail(self, key, error):
+        self.append({"key": key, "state": "failed", "error": str(error)})
+
+    # Returns the last entry of every attempt that has not failed, with the time and text of when it started.
+    def read(self):
+        attempts = {}
+        if not os.path.exists(self.path):
+            return attempts
+        with self.lock:
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line that was being written when the crossposter stopped.
+                        continue
+                    if entry.get("state") == "started":
+                        attempts[entry["key"]] = entry
+                    elif entry["key"] in attempts:
+                        attempts[entry["key"]].update(entry)
+        return {key: entry for key, entry in attempts.items() if entry["state"] != "failed"}
+
+    # Returns the attempt with the given key if it was started but its outcome is unknown, or None.
+    def pending(self, key):
+        attempt = self.read().get(key)
+        if attempt and attempt["state"] == "started":
+            return attempt
+        return None
+
+    # Returns the parts of a thread sent by the pending attempt with the given key, or None.
+    def sent(self, key):
+        attempt = self.pending(key)
+        return attempt.get("sent") if attempt else None
+
+    # Rewrites the journal with only the attempts whose outcome is still unknown, dropping those older than
+    # JOURNAL_DAYS. Only done when no posts are being sent, after the outcomes have been saved to the database.
+    def compact(self):
+        timelimit = arrow.utcnow().shift(days=-JOURNAL_DAYS).timestamp()
+        attempts = [
+            attempt
+            for attempt in self.read().values()
+            if attempt["state"] == "started" and attempt["time"] > timelimit
+        ]
+        with self.lock:
+            if not attempts:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            with open(self.path + ".tmp", "w") as file:
+                for attempt in attempts:
+                    file.write(json.dumps(attempt) + "\n")
+            os.replace(self.path + ".tmp", self.path)
+
+
+def idempotency_key(cid, platform):
+    return "%s-%s" % (platform, cid)
+
+
+journal = PublishJournal(publish_journal_path)
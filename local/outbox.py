@@ -0,0 +1,137 @@
+from loguru import logger
+from settings.paths import outbox_path
+import json, os, random, threading, arrow
+
+# Failed crossposts are retried after RETRY_BASE_DELAY seconds, doubling with every failed attempt up to
+# RETRY_MAX_DELAY. A random part of the delay is left out, so that posts that failed together are not all
+# retried at the same moment.
+RETRY_BASE_DELAY = 5 * 60
+RETRY_MAX_DELAY = 6 * 60 * 60
+PLATFORMS = ("twitter", "mastodon")
+
+
+# Posts that still have to be sent to one or both platforms, together with the post info needed to send them
+# and when each platform should be tried again. The outbox is kept in a file in db/, so retries survive between
+# runs and don't depend on the post still being in the author feed.
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                self.entries = json.load(file)
+        except Exception as e:
+            logger.error(f"Unable to read {self.path}: {e}")
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.entries, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    # Schedules the next attempt at sending a post to a platform, at the time given or after the backoff delay
+    # for the number of attempts made so far.
+    def schedule(self, cid, post, platform, attempts, error, retry_at=None):
+        if retry_at is None:
+            retry_at = arrow.utcnow().timestamp() + retry_delay(attempts)
+        with self.lock:
+            self.load()
+            entry = self.entries.setdefault(cid, {"post": dump_post(post), "platforms": {}})
+            entry["platforms"][platform] = {
+                "attempts": attempts,
+                "next_attempt": retry_at,
+                "error": str(error),
+            }
+            self.save()
+        logger.info(
+            "Post %s will be sent to %s again %s"
+            % (cid, platform.capitalize(), arrow.Arrow.fromtimestamp(retry_at).humanize())
+        )
+
+    # Removes the platforms a post no longer has to be sent to, and the post once there are none left.
+    def settle(self, cid, platforms):
+        with self.lock:
+            self.load()
+            if cid not in self.entries:
+                return
+            for platform in platforms:
+                self.entries[cid]["platforms"].pop(platform, None)
+            if not self.entries[cid]["platforms"]:
+                del self.entries[cid]
+            self.save()
+
+    def discard(self, cid):
+        self.settle(cid, PLATFORMS)
+
+    # Returns the time the next attempt at sending a post to a platform is due, or None if it is not waiting.
+    def next_attempt(self, cid, platform):
+        with self.lock:
+            self.load()
+            state = self.entries.get(cid, {}).get("platforms", {}).get(platform)
+        return state["next_attempt"] if state else None
+
+    def waiting(self, cid, platform):
+        retry_at = self.next_attempt(cid, platform)
+        return retry_at is not None and retry_at > arrow.utcnow().timestamp()
+
+    def __contains__(self, cid):
+        with self.lock:
+            self.load()
+            return cid in self.entries
+
+    # Returns the posts that are due to be sent to at least one platform, newest first like the author feed.
+    def due(self):
+        now = arrow.utcnow().timestamp()
+        with self.lock:
+            self.load()
+            due = {
+                cid: load_post(entry["post"])
+                for cid, entry in self.entries.items()
+                if any(state["next_attempt"] <= now for state in entry["platforms"].values())
+            }
+        return dict(sorted(due.items(), key=lambda item: item[1]["timestamp"], reverse=True))
+
+    # Returns the time the next attempt in the outbox is due, or None if there are none in the future. Posts that
+    # are already due and were not sent, e.g. because max_per_hour was reached, are sent by the next run.
+    def next_due(self):
+        now = arrow.utcnow().timestamp()
+        with self.lock:
+            self.load()
+            return min(
+                (
+                    state["next_attempt"]
+                    for entry in self.entries.values()
+                    for state in entry["platforms"].values()
+                    if state["next_attempt"] > now
+                ),
+                default=None,
+            )
+
+
+# Exponential backoff with jitter. The delay after the first failed attempt is RETRY_BASE_DELAY.
+def retry_delay(attempts):
+    delay = min(RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0), RETRY_MAX_DELAY)
+    return random.uniform(delay / 2, delay)
+
+
+def dump_post(post):
+    indexed_at = post.get("indexed_at")
+    return dict(
+        post, timestamp=post["timestamp"].isoformat(), indexed_at=indexed_at and indexed_at.isoformat()
+    )
+
+
+def load_post(post):
+    # Posts put in the outbox before the time of indexing was kept fall back on the time they were created.
+    indexed_at = post.get("indexed_at") or post["timestamp"]
+    return dict(post, timestamp=arrow.get(post["timestamp"]), indexed_at=arrow.get(indexed_at))
+
+
+outbox = Outbox(outbox_path)
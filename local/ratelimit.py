@@ -0,0 +1,189 @@
+from loguru import logger
+from settings.paths import rate_limit_path
+from urllib.parse import urlsplit
+import atexit, json, os, re, threading, time, arrow
+
+# Rate limit headers sent by each platform. Bluesky sends RateLimit-*, Twitter x-rate-limit-* along with separate
+# daily limits for the user and the app, and Mastodon X-RateLimit-*. Headers are looked up case-insensitively.
+HEADER_PREFIXES = (
+    "ratelimit-",
+    "x-rate-limit-",
+    "x-ratelimit-",
+    "x-user-limit-24hour-",
+    "x-app-limit-24hour-",
+)
+# Path segments that are IDs are left out of endpoint names, so that e.g. all media status checks share a bucket.
+# The first segment is the API version on Twitter, e.g. /2/tweets, and is always kept.
+ID_SEGMENT = re.compile(r"^\d+$")
+# How long to wait when a rate limit is exceeded without the platform saying when it resets, which is the
+# window Twitter uses for most endpoints.
+DEFAULT_WAIT = 15 * 60
+
+
+# Raised instead of sending a request that would go over the rate limit, or when a platform answers that
+# it has been exceeded. reset is the time (in seconds since the epoch) when the request can be sent again.
+class RateLimitExceeded(Exception):
+    def __init__(self, service, endpoint, reset):
+        self.service = service
+        self.endpoint = endpoint
+        self.reset = reset
+        super().__init__(
+            "%s rate limit for %s reached until %s"
+            % (service, endpoint, arrow.Arrow.fromtimestamp(reset).format("YYYY-MM-DD HH:mm:ss"))
+        )
+
+
+# Token bucket for one rate limit of one endpoint. The platforms all use fixed windows, so the bucket holds the
+# remaining requests reported by the last response, and is refilled to the limit when the window resets.
+class TokenBucket:
+    def __init__(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def refill(self, now):
+        if self.reset <= now:
+            self.remaining = self.limit
+
+    # Returns the number of requests that can be sent now, keeping buffer percent of the limit in reserve.
+    def available(self, now, buffer=0):
+        self.refill(now)
+        return self.remaining - int(self.limit * buffer / 100)
+
+
+# Keeps a token bucket per service, endpoint and limit, fed from the headers of every response. Work is asked
+# for permission before it is sent, and is deferred until the bucket resets instead of being sent anyway.
+class RateLimiter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.deferred = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as file:
+                saved = json.load(file)
+            for key, bucket in saved.items():
+                service, endpoint, limit_name = key.split(" ", 2)
+                self.buckets.setdefault((service, endpoint), {})[limit_name] = TokenBucket(*bucket)
+        except Exception as e:
+            # Older versions saved only the reset time of Bluesky in this file.
+            logger.info("Unable to read saved rate limits: %s" % e)
+
+    # Saves the buckets that have not reset yet, so that a new run knows about limits reached by the last one.
+    def save(self):
+        now = time.time()
+        with self.lock:
+            saved = {
+                "%s %s %s" % (service, endpoint, limit_name): [bucket.limit, bucket.remaining, bucket.reset]
+                for (service, endpoint), buckets in self.buckets.items()
+                for limit_name, bucket in buckets.items()
+                if bucket.reset > now
+            }
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(saved, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    # Updates the buckets of an endpoint from the headers of a response to a request to url.
+    def record(self, service, url, headers):
+        endpoint = endpoint_name(url)
+        headers = {key.lower(): value for key, value in headers.items()}
+        now = time.time()
+        with self.lock:
+            for prefix in HEADER_PREFIXES:
+                limit = headers.get(prefix + "limit")
+                remaining = headers.get(prefix + "remaining")
+                reset = headers.get(prefix + "reset")
+                if limit is None or remaining is None or reset is None:
+                    continue
+                try:
+                    bucket = TokenBucket(int(limit), int(remaining), parse_reset(reset, now))
+                except ValueError:
+                    logger.debug("Unable to parse rate limit headers %s*" % prefix)
+                    continue
+                self.buckets.setdefault((service, endpoint), {})[prefix.rstrip("-")] = bucket
+
+    # Takes count tokens from every bucket of the endpoint. If any of them does not have enough tokens left,
+    # nothing is taken and RateLimitExceeded is raised with the time the endpoint can be used again.
+    def acquire(self, service, endpoint, count=1, buffer=0):
+        now = time.time()
+        with self.lock:
+            buckets = self.buckets.get((service, endpoint), {}).values()
+            blocked = [bucket.reset for bucket in buckets if bucket.available(now, buffer) < count]
+            if blocked:
+                reset = max(blocked)
+                self.deferred[(service, endpoint)] = reset
+                raise RateLimitExceeded(service, endpoint, reset)
+            for bucket in buckets:
+                bucket.remaining -= count
+
+    # Returns the error to raise when a platform has answered that the rate limit of an endpoint is exceeded.
+    # The reset time comes from the headers of that answer, or is a guess if there were none.
+    def exceeded(self, service, endpoint, wait=DEFAULT_WAIT):
+        now = time.time()
+        with self.lock:
+            resets = [bucket.reset for bucket in self.buckets.get((service, endpoint), {}).values()]
+            reset = max([reset for reset in resets if reset > now], default=now + wait)
+            self.deferred[(service, endpoint)] = reset
+        return RateLimitExceeded(service, endpoint, reset)
+
+    # Returns the time until which all requests to a service should wait, or None if the service is not limited.
+    def blocked_until(self, service, buffer=0):
+        now = time.time()
+        with self.lock:
+            resets = [
+                bucket.reset
+                for (bucket_service, _), buckets in self.buckets.items()
+                if bucket_service == service
+                for bucket in buckets.values()
+                if bucket.available(now, buffer) <= 0
+            ]
+        return max(resets) if resets else None
+
+    # Returns the earliest time deferred work can be sent, and forgets about work deferred until before then.
+    def next_retry(self):
+        now = time.time()
+        with self.lock:
+            self.deferred = {key: reset for key, reset in self.deferred.items() if reset > now}
+            return min(self.deferred.values()) if self.deferred else None
+
+    # Returns the limit, remaining requests and reset time of the most limited bucket of an endpoint, as last
+    # reported by the platform. The reset time is None if nothing is known about the current window.
+    def status(self, service, endpoint):
+        now = time.time()
+        with self.lock:
+            buckets = [
+                bucket
+                for bucket in self.buckets.get((service, endpoint), {}).values()
+                if bucket.reset > now
+            ]
+            if not buckets:
+                return None, None, None
+            bucket = min(buckets, key=lambda bucket: bucket.available(now))
+            return bucket.limit, bucket.remaining, bucket.reset
+
+
+# Turns the URL of a request into the name of its endpoint, e.g. /api/v1/media/:id.
+def endpoint_name(url):
+    parts = (urlsplit(url).path or url).split("/")
+    return "/".join(parts[:2] + [":id" if ID_SEGMENT.match(part) else part for part in parts[2:]])
+
+
+# The reset header is seconds since the epoch on Bluesky and Twitter, and an ISO 8601 time on Mastodon.
+# Small numbers are treated as seconds from now, as in the IETF RateLimit header draft.
+def parse_reset(reset, now):
+    try:
+        value = float(reset)
+    except ValueError:
+        return arrow.get(reset).timestamp()
+    if value < 1000000000:
+        return now + value
+    return value
+
+
+limiter = RateLimiter(rate_limit_path)
+atexit.register(limiter.save)
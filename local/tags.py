@@ -0,0 +1,46 @@
+from settings import settings
+import re
+
+# A tag ends where the word does, apart from punctuation after it, so that #t matches "#t." but not "#travel".
+TAG_END = r"(?=[^\w\s]*(?:\s|$))"
+
+
+# Matches the tags that keep posts from being crossposted to each platform. All tags are matched at once by a
+# single regular expression, compiled when the matcher is made, instead of looking for every tag separately.
+class TagMatcher:
+    def __init__(self, tags_by_platform):
+        self.platforms = {}
+        for platform, tags in tags_by_platform.items():
+            for tag in tags:
+                tag = tag.strip()
+                if not tag:
+                    continue
+                # Tags are hashtags, also when they are set without the #.
+                if not tag.startswith("#"):
+                    tag = "#" + tag
+                # Hashtags are not case sensitive, so neither are the tags.
+                self.platforms.setdefault(tag.lower(), set()).add(platform)
+        self.pattern = None
+        if self.platforms:
+            # Longer tags are tried first, so that a tag is not cut short by another tag it starts with.
+            # The pattern starts with the # so that the text can be searched for it quickly, and then
+            # checks that the # starts a word.
+            tags = sorted(self.platforms, key=len, reverse=True)
+            self.pattern = re.compile(
+                r"#(?<!\S#)(%s)%s" % ("|".join(re.escape(tag[1:]) for tag in tags), TAG_END),
+                re.IGNORECASE,
+            )
+
+    # Returns the platforms that the text is not to be crossposted to because of the tags in it.
+    def match(self, text):
+        ignored = set()
+        if self.pattern is None or "#" not in text:
+            return ignored
+        for match in self.pattern.finditer(text):
+            ignored |= self.platforms["#" + match.group(1).lower()]
+        return ignored
+
+
+ignored_tags = TagMatcher(
+    {"twitter": settings.ignore_tags_twitter, "mastodon": settings.ignore_tags_mastodon}
+)
@@ -1,51 +1,164 @@
-from mastodon import Mastodon
+from concurrent.futures import ThreadPoolExecutor
+from mastodon import Mastodon, MastodonAPIError, MastodonRatelimitError
 from loguru import logger
 from settings import settings
 from settings.auth import *
+from local.ratelimit import RateLimitExceeded, limiter
+import time
+
+# Endpoints used for rate limiting. Every request to the instance is recorded by the rate limiter, and toots and
+# media are only sent if the limits of these endpoints allow it.
+STATUS_ENDPOINT = "/api/v1/statuses"
+MEDIA_ENDPOINT = "/api/v2/media"
+
+# How long to wait before checking if uploaded media has been processed, which is doubled after every check
+# up to MEDIA_POLL_MAX_DELAY, and how long to wait in total before giving up.
+MEDIA_POLL_DELAY = 0.5
+MEDIA_POLL_MAX_DELAY = 8
+MEDIA_PROCESSING_TIMEOUT = 300
+# Mastodon only keeps idempotency keys for an hour, after which a toot sent again with the same key is posted
+# twice. Attempts older than this are looked up among the account's toots instead, with some margin for the
+# time between the attempt being journaled and reaching the instance.
+IDEMPOTENCY_KEY_LIFETIME = 50 * 60
+# How many of the account's latest toots are looked through for an earlier attempt.
+FIND_TOOT_LIMIT = 40
+
+
+def record_rate_limit(response, *args, **kwargs):
+    limiter.record("mastodon", response.url, response.headers)
 
 
 if settings.Mastodon:
-    mastodon = Mastodon(access_token=MASTODON_TOKEN, api_base_url=MASTODON_INSTANCE)
+    # Mastodon.py would otherwise sleep inside a request until the rate limit resets, holding up everything
+    # else. Instead it raises an error, and the post is deferred.
+    mastodon = Mastodon(
+        access_token=MASTODON_TOKEN,
+        api_base_url=MASTODON_INSTANCE,
+        ratelimit_method="throw",
+    )
+    mastodon.session.hooks["response"].append(record_rate_limit)
 
 
-# More or less the exact same function as for tweeting, but for tooting.
-def toot(post, reply_to_post, quoted_post, media, visibility="unlisted"):
+# More or less the exact same function as for tweeting, but for tooting. Raises RateLimitExceeded, without
+# sending anything, if the rate limit does not allow the toot and its media to be sent. If a toot with the same
+# idempotency key was posted within the last hour, the instance returns that toot instead of posting it again.
+def toot(post, reply_to_post, quoted_post, media, visibility="unlisted", idempotency_key=None):
     # Since mastodon does not have a quote repost function, quote posts are turned into replies. If the post is both
     # a reply and a quote post, the quote is replaced with a url to the post quoted.
     if reply_to_post is None and quoted_post:
         reply_to_post = quoted_post
     elif reply_to_post is not None and quoted_post:
-        post_url = MASTODON_INSTANCE + "@" + MASTODON_HANDLE + "/" + str(quoted_post)
-        post += "\n" + post_url
+        post += "\n" + quote_url(quoted_post)
+    if media:
+        limiter.acquire("mastodon", MEDIA_ENDPOINT, len(media))
+    limiter.acquire("mastodon", STATUS_ENDPOINT)
     media_ids = []
     # If post includes images, images are uploaded so that they can be included in the toot
     if media:
-        for item in media:
-            # If alt text was added to the image on bluesky, it's also added to the image on mastodon,
-            # otherwise it will be uploaded without alt text.
-            if item["alt"]:
-                logger.info(
-                    "Uploading media "
-                    + item["filename"]
-                    + " with alt: "
-                    + item["alt"]
-                    + " to mastodon"
-                )
-                res = mastodon.media_post(
-                    item["filename"], description=item["alt"], synchronous=True
-                )
-            else:
-                logger.info("Uploading media " + item["filename"])
-                res = mastodon.media_post(item["filename"], synchronous=True)
-            media_ids.append(res.id)
-    a = mastodon.status_post(
-        post, in_reply_to_id=reply_to_post, media_ids=media_ids, visibility=visibility
-    )
+        try:
+            media_ids = upload_media(media)
+        except RateLimitExceeded:
+            raise
+        except MastodonRatelimitError:
+            raise limiter.exceeded("mastodon", MEDIA_ENDPOINT)
+        except Exception as e:
+            logger.error(
+                "Uploading media to mastodon failed (%s), retrying one file at a time" % e
+            )
+            media_ids = [upload_media_item(item, synchronous=True).id for item in media]
+    try:
+        a = mastodon.status_post(
+            post,
+            in_reply_to_id=reply_to_post,
+            media_ids=media_ids,
+            visibility=visibility,
+            idempotency_key=idempotency_key,
+        )
+    except MastodonRatelimitError:
+        raise limiter.exceeded("mastodon", STATUS_ENDPOINT)
     logger.info("Posted to mastodon")
     id = a["id"]
     return id
 
 
+# Uploads all media of a post at the same time, without waiting for the instance to process each file. The
+# uploads are then polled until all of them have been processed, waiting a little longer between each check.
+# Returns the IDs of the uploaded media.
+def upload_media(media):
+    with ThreadPoolExecutor(max_workers=len(media)) as executor:
+        attachments = list(executor.map(upload_media_item, media))
+    pending = [attachment for attachment in attachments if attachment.get("url") is None]
+    delay = MEDIA_POLL_DELAY
+    deadline = time.monotonic() + MEDIA_PROCESSING_TIMEOUT
+    while pending:
+        if time.monotonic() > deadline:
+            raise TimeoutError("Media was not processed in time")
+        time.sleep(delay)
+        delay = min(delay * 2, MEDIA_POLL_MAX_DELAY)
+        pending = [
+            attachment
+            for attachment in pending
+            if mastodon.media(attachment).get("url") is None
+        ]
+    return [attachment.id for attachment in attachments]
+
+
+def upload_media_item(item, synchronous=False):
+    # If alt text was added to the image on bluesky, it's also added to the image on mastodon,
+    # otherwise it will be uploaded without alt text.
+    if item["alt"]:
+        logger.info(
+            "Uploading media "
+            + item["filename"]
+            + " with alt: "
+            + item["alt"]
+            + " to mastodon"
+        )
+    else:
+        logger.info("Uploading media " + item["filename"])
+    # The media is read from the downloaded file, so the type and name are given along with it.
+    with item["file"].open() as file:
+        try:
+            return mastodon.media_post(
+                file,
+                mime_type=item["mime_type"],
+                file_name=item["filename"],
+                description=item["alt"] or None,
+                synchronous=synchronous,
+            )
+        except MastodonRatelimitError:
+            raise limiter.exceeded("mastodon", MEDIA_ENDPOINT)
+
+
+# Returns whether an error from toot() was an answer from the instance, meaning that the toot was not posted.
+def toot_rejected(error):
+    return isinstance(error, MastodonAPIError)
+
+
+def quote_url(toot_id):
+    return MASTODON_INSTANCE + "@" + MASTODON_HANDLE + "/" + str(toot_id)
+
+
+# Looks for a toot of the post among the latest toots of the account posted since the given time, for posts that
+# may have been tooted without being saved, once the idempotency key of the attempt can no longer be trusted.
+# The text of each toot is read from its source, since the content the instance returns is rendered as HTML.
+# Returns the toot ID, or None if it was not found.
+def find_toot(post_text, since):
+    post_text = post_text.strip()
+    account = mastodon.me()
+    for status in mastodon.account_statuses(account, exclude_reblogs=True, limit=FIND_TOOT_LIMIT):
+        if status["created_at"] < since.datetime:
+            break
+        text = mastodon.status_source(status)["text"].strip()
+        # Replies that quote a post have the URL of the quoted toot added on a line of its own.
+        if text == post_text or (
+            text.startswith(post_text + "\n" + quote_url(""))
+            and "\n" not in text[len(post_text) + 1 :]
+        ):
+            return status["id"]
+    return None
+
+
 def retoot(toot_id):
     a = mastodon.status_reblog(toot_id)
     logger.info("Boosted toot " + str(toot_id))
@@ -1,212 +1,591 @@
-import random, string, urllib, arrow, requests, traceback
+import hashlib, io, mimetypes, os, random, re, string, threading, arrow, httpx, traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from loguru import logger
 from settings import settings
 from settings.paths import *
 from local.db import db_write
-from output.twitter import tweet, retweet, delete as delete_tweet
-from output.mastodon import toot, retoot, delete as delete_toot
+from local.functions import media_cache_find
+from local.ratelimit import RateLimitExceeded
+from local.outbox import outbox
+from local.journal import journal, idempotency_key
+from output.twitter import tweet, tweet_rejected, find_tweet, retweet, delete as delete_tweet
+from output.mastodon import (
+    toot,
+    toot_rejected,
+    find_toot,
+    retoot,
+    delete as delete_toot,
+    IDEMPOTENCY_KEY_LIFETIME,
+)
+
+# Posts are sent to Twitter and Mastodon from a pool of threads for each platform, which limits how many
+# requests are sent to each platform at the same time. Separate pools make sure posts waiting for one platform
+# never hold up the other.
+twitter_publisher = ThreadPoolExecutor(
+    max_workers=settings.max_parallel_twitter, thread_name_prefix="twitter"
+)
+mastodon_publisher = ThreadPoolExecutor(
+    max_workers=settings.max_parallel_mastodon, thread_name_prefix="mastodon"
+)
+# Media is downloaded with a single client that keeps connections open, by a limited number of threads shared
+# by all posts being sent.
+MEDIA_WORKERS = 4
+media_client = httpx.Client(
+    timeout=httpx.Timeout(30, connect=10),
+    limits=httpx.Limits(max_connections=MEDIA_WORKERS, max_keepalive_connections=MEDIA_WORKERS),
+    follow_redirects=True,
+)
+media_downloader = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Blob CIDs on Bluesky are base32 encoded CIDv1, which always start with "baf". On the CDN the CID is the path
+# segment after the DID of the account, e.g. /img/feed_fullsize/plain/did:plc:.../bafkrei...@jpeg. The whole
+# segment is matched, since a DID can contain "baf" too.
+CID_PATTERN = re.compile(r"/(baf[a-z2-7]{20,})(?:@|$)")
+DEFAULT_EXTENSIONS = {"image": ".jpg", "video": ".mp4"}
 
 
 def post(posts, database, post_cache):
     # The updates status is set to false until anything has been altered in the databse. If nothing has been posted in a run, we skip resaving the database.
     updates = False
-    # Running through the posts dictionary reversed, to get oldest posts first.
-    for cid in reversed(list(posts.keys())):
-        post = posts[cid]
-        # Checking if a maximum amount of posts per hour is set, and if so if it has been reached.
-        if settings.max_per_hour != 0 and len(post_cache) >= settings.max_per_hour:
-            logger.info("Max posts per hour reached.")
-            break
-        # If a post is posted, we want to add a timestamp to the post_cache. Since there are several
-        # reasons why a post might not be posted, we start out with this set to false for each post,
-        # and change it to true if a post is actually sent.
-        posted = False
-        # Checking if the post is already in the database, and in that case getting the IDs for the post
-        # on twitter and mastodon. If one or both of these IDs are empty, post will be sent.
-        # Also checking the existing fail count against the max_retries set in settings, to avoid
-        # retrying a failure so much that the poster gets ratelimited
-        tweet_id = ""
-        toot_id = ""
-        t_fail = 0
-        m_fail = 0
-        if cid in database:
-            tweet_id = database[cid]["ids"]["twitter_id"]
-            toot_id = database[cid]["ids"]["mastodon_id"]
-            t_fail = database[cid]["failed"]["twitter"]
-            m_fail = database[cid]["failed"]["mastodon"]
-        if m_fail >= settings.max_retries:
-            logger.info("Error limit reached, not posting to Mastodon")
-            if not toot_id:
-                updates = True
-                toot_id = "FailedToPost"
-        if t_fail >= settings.max_retries:
-            logger.info("Error limit reached, not posting to Twitter")
-            if not tweet_id:
-                updates = True
-                tweet_id = "FailedToPost"
-        tweet_reply = ""
-        toot_reply = ""
-        tweet_quote = ""
-        toot_quote = ""
-        # If the post has already been sent to both twitter and mastodon and is not a repost, no
-        # further action is needed.
-        if tweet_id and toot_id and not post["repost"]:
-            continue
-        # If a retweet is found within the last hour, we check the cache to see if it has already been retweeted
-        repost_timelimit = arrow.utcnow().shift(hours=-1)
-        if cid in post_cache:
-            repost_timelimit = post_cache[cid]
-        # If it is a reply, we get the IDs of the posts we want to reply to from the database.
-        # If post is not found in database, we can't continue the thread on mastodon and twitter,
-        # and so we skip it.
-        if post["reply_to_post"] in database:
-            tweet_reply = database[post["reply_to_post"]]["ids"]["twitter_id"]
-            toot_reply = database[post["reply_to_post"]]["ids"]["mastodon_id"]
-        elif post["reply_to_post"] and post["reply_to_post"] not in database:
-            logger.info(
-                "Post " + cid + " was a reply to a post that is not in the database."
+    # Posts are sent oldest first. Replies and quotes need the IDs of the post they reply to or quote, so if that
+    # post is also about to be sent, they wait until it has been saved to the database. All other posts are sent
+    # in parallel, up to max_parallel_posts at a time.
+    order = list(reversed(list(posts.keys())))
+    children = {cid: [] for cid in order}
+    waiting = {}
+    for cid in order:
+        parents = {posts[cid]["reply_to_post"], posts[cid]["quoted_post"]}
+        parents &= posts.keys() - {cid}
+        waiting[cid] = len(parents)
+        for parent in parents:
+            children[parent].append(cid)
+    ready = [cid for cid in order if not waiting[cid]]
+    running = {}
+    limit_reached = False
+    with ThreadPoolExecutor(
+        max_workers=settings.max_parallel_posts, thread_name_prefix="post"
+    ) as executor:
+        while ready or running:
+            while ready and not limit_reached:
+                # Checking if a maximum amount of posts per hour is set, and if so if it has been reached.
+                # Posts that are still being sent are counted as well, since they may be added to the cache.
+                if (
+                    settings.max_per_hour != 0
+                    and len(post_cache) + len(running) >= settings.max_per_hour
+                ):
+                    logger.info("Max posts per hour reached.")
+                    limit_reached = True
+                    break
+                cid = ready.pop(0)
+                future = executor.submit(post_one, cid, posts[cid], database, post_cache)
+                running[future] = cid
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                cid = running.pop(future)
+                updates = future.result() or updates
+                # The post is now in the database, so replies and quotes of it can be sent.
+                for child in children[cid]:
+                    waiting[child] -= 1
+                    if not waiting[child]:
+                        ready.append(child)
+            ready.sort(key=order.index)
+    return updates, database, post_cache
+
+
+# Sends a single post to Twitter and Mastodon and saves the result to the database.
+# Returns whether the database has been updated.
+def post_one(cid, post, database, post_cache):
+    updates = False
+    # If a post is posted, we want to add a timestamp to the post_cache. Since there are several
+    # reasons why a post might not be posted, we start out with this set to false for each post,
+    # and change it to true if a post is actually sent.
+    posted = False
+    # Checking if the post is already in the database, and in that case getting the IDs for the post
+    # on twitter and mastodon. If one or both of these IDs are empty, post will be sent.
+    # Also checking the existing fail count against the max_retries set in settings, to avoid
+    # retrying a failure so much that the poster gets ratelimited
+    tweet_id = ""
+    toot_id = ""
+    t_fail = 0
+    m_fail = 0
+    if cid in database:
+        tweet_id = database[cid]["ids"]["twitter_id"]
+        toot_id = database[cid]["ids"]["mastodon_id"]
+        t_fail = database[cid]["failed"]["twitter"]
+        m_fail = database[cid]["failed"]["mastodon"]
+    if m_fail >= settings.max_retries:
+        logger.info("Error limit reached, not posting to Mastodon")
+        if not toot_id:
+            updates = True
+            toot_id = "FailedToPost"
+    if t_fail >= settings.max_retries:
+        logger.info("Error limit reached, not posting to Twitter")
+        if not tweet_id:
+            updates = True
+            tweet_id = "FailedToPost"
+    tweet_reply = ""
+    toot_reply = ""
+    tweet_quote = ""
+    toot_quote = ""
+    # If the post has already been sent to both twitter and mastodon and is not a repost, no
+    # further action is needed.
+    if tweet_id and toot_id and not post["repost"]:
+        outbox.discard(cid)
+        return updates
+    # If a retweet is found within the last hour, we check the cache to see if it has already been retweeted
+    repost_timelimit = arrow.utcnow().shift(hours=-1)
+    if cid in post_cache:
+        repost_timelimit = post_cache[cid]
+    # If it is a reply, we get the IDs of the posts we want to reply to from the database.
+    # If post is not found in database, we can't continue the thread on mastodon and twitter,
+    # and so we skip it.
+    if post["reply_to_post"] in database:
+        tweet_reply = database[post["reply_to_post"]]["ids"]["twitter_id"]
+        toot_reply = database[post["reply_to_post"]]["ids"]["mastodon_id"]
+    elif post["reply_to_post"] and post["reply_to_post"] not in database:
+        logger.info(
+            "Post " + cid + " was a reply to a post that is not in the database."
+        )
+        outbox.discard(cid)
+        return skip(cid, tweet_id, toot_id, t_fail, m_fail, database)
+    # If post is a quote post we get the IDs of the posts we want to quote from the database.
+    # If the posts are not found in the database we check if the quote_post setting is true or false in settings.
+    # If true we add the URL of the bluesky post to the text of the post, if false we skip the post.
+    if post["quoted_post"] in database:
+        tweet_quote = database[post["quoted_post"]]["ids"]["twitter_id"]
+        toot_quote = database[post["quoted_post"]]["ids"]["mastodon_id"]
+    elif post["quoted_post"] and post["quoted_post"] not in database:
+        if settings.quote_posts and post["quote_url"] not in post["text"]:
+            post["text"] += "\n" + post["quote_url"]
+        elif not settings.quote_posts:
+            logger.error(
+                "Post " + cid + " was a quote of a post that is not in the database."
             )
-            continue
-        # If post is a quote post we get the IDs of the posts we want to quote from the database.
-        # If the posts are not found in the database we check if the quote_post setting is true or false in settings.
-        # If true we add the URL of the bluesky post to the text of the post, if false we skip the post.
-        if post["quoted_post"] in database:
-            tweet_quote = database[post["quoted_post"]]["ids"]["twitter_id"]
-            toot_quote = database[post["quoted_post"]]["ids"]["mastodon_id"]
-        elif post["quoted_post"] and post["quoted_post"] not in database:
-            if settings.quote_posts and post["quote_url"] not in post["text"]:
-                post["text"] += "\n" + post["quote_url"]
-            elif not settings.quote_posts:
-                logger.error(
-                    "Post "
-                    + cid
-                    + " was a quote of a post that is not in the database."
-                )
-                continue
-        # In case the tweet or toot reply/quote variables are empty, we set them to None, to make sure they are in the correct format for
-        # the api requests. This is not necessary for the toot_quote variable, as it is not sent as a parameter in itself anyway.
-        if not tweet_reply:
-            tweet_reply = None
-        if not toot_reply:
-            toot_reply = None
-        if not tweet_quote:
-            tweet_quote = None
-        # If either tweet or toot has not previously been posted, we download images (given the post includes images).
-        media = []
-        if post["media"] and (not tweet_id or not toot_id):
-            if post["media"]["type"] == "image":
-                media = get_images(post["media"]["data"])
-            elif post["media"]["type"] == "video":
-                media = get_video(post["media"]["data"])
-        # If mastodon is set to false, the post is not sent to mastodon.
-        if not post["twitter"]:
+            outbox.discard(cid)
+            return skip(cid, tweet_id, toot_id, t_fail, m_fail, database)
+    # In case the tweet or toot reply/quote variables are empty, we set them to None, to make sure they are in the correct format for
+    # the api requests. This is not necessary for the toot_quote variable, as it is not sent as a parameter in itself anyway.
+    if not tweet_reply:
+        tweet_reply = None
+    if not toot_reply:
+        toot_reply = None
+    if not tweet_quote:
+        tweet_quote = None
+    # If either tweet or toot has not previously been posted, we download images (given the post includes images).
+    media = []
+    if post["media"] and (not tweet_id or not toot_id):
+        if post["media"]["type"] == "image":
+            media = get_images(post["media"]["data"])
+        elif post["media"]["type"] == "video":
+            media = get_video(post["media"]["data"])
+    # Twitter and Mastodon are posted to at the same time, so a slow upload to one of them does not
+    # hold up the other. The results are then saved to the database together.
+    twitter_result = twitter_publisher.submit(
+        send_to_twitter,
+        cid,
+        post,
+        tweet_id,
+        t_fail,
+        tweet_reply,
+        tweet_quote,
+        media,
+        repost_timelimit,
+    )
+    mastodon_result = mastodon_publisher.submit(
+        send_to_mastodon,
+        cid,
+        post,
+        toot_id,
+        m_fail,
+        toot_reply,
+        toot_quote,
+        media,
+        repost_timelimit,
+    )
+    tweet_id, t_fail, tweet_posted, tweet_updates = twitter_result.result()
+    toot_id, m_fail, toot_posted, toot_updates = mastodon_result.result()
+    if media:
+        for item in media:
+            item["file"].close()
+    posted = tweet_posted or toot_posted
+    updates = updates or tweet_updates or toot_updates
+    # Platforms the post has been sent to, or given up on, are removed from the outbox.
+    outbox.settle(cid, [platform for platform, id in (("twitter", tweet_id), ("mastodon", toot_id)) if id])
+    # Saving post to database
+    database = db_write(
+        cid, tweet_id, toot_id, {"twitter": t_fail, "mastodon": m_fail}, database
+    )
+    if posted:
+        post_cache[cid] = arrow.utcnow()
+    return updates
+
+
+# Saves a post that can never be sent as skipped, so that it counts as handled and the feed watermark can move
+# past it. Returns that the database has been updated.
+def skip(cid, tweet_id, toot_id, t_fail, m_fail, database):
+    db_write(
+        cid,
+        tweet_id or "skipped",
+        toot_id or "skipped",
+        {"twitter": t_fail, "mastodon": m_fail},
+        database,
+    )
+    return True
+
+
+# Sends a post to Twitter, or retweets it if it is a repost. Returns the tweet ID and fail count to save
+# to the database, whether anything was posted and whether the database needs to be updated.
+def send_to_twitter(
+    cid, post, tweet_id, t_fail, tweet_reply, tweet_quote, media, repost_timelimit
+):
+    posted = False
+    updates = False
+    # If twitter is set to false, the post is not sent to twitter.
+    if not post["twitter"]:
+        tweet_id = "skipped"
+        logger.info("Not posting to Twitter because posting was set to false.")
+    elif tweet_id and not post["repost"]:
+        logger.info("Post " + cid + " already sent to twitter.")
+    # if the post already exists and is a repost, we check if it has already been reposted, and if not, repost it.
+    elif tweet_id and post["repost"] and post["timestamp"] > repost_timelimit:
+        try:
+            # This is where retweets would go if they weren't locked behind a paywall.
+            pass
+            # retweet(tweet_id)
+            # posted = True
+        except Exception as e:
+            logger.error(traceback.format_exc())
+    # Posts that have failed before are only sent again once their next attempt in the outbox is due, and
+    # replies wait for the post they reply to.
+    elif not tweet_id and outbox.waiting(cid, "twitter"):
+        logger.info("Post " + cid + " is waiting to be sent to Twitter again")
+    elif not tweet_id and outbox.waiting(post["reply_to_post"], "twitter"):
+        retry_at = outbox.next_attempt(post["reply_to_post"], "twitter")
+        outbox.schedule(cid, post, "twitter", t_fail, "Waiting for the post replied to", retry_at)
+    # Trying to post to twitter. If posting fails the post ID is set to an empty string, letting
+    # the code know it should try again next time the code is run.
+    elif not tweet_id and tweet_reply not in [
+        "skipped",
+        "FailedToPost",
+        "duplicate",
+    ]:
+        updates = True
+        try:
+            tweet_id = journaled(
+                cid,
+                "twitter",
+                post,
+                lambda key: tweet(
+                    post["text"],
+                    tweet_reply,
+                    tweet_quote,
+                    media,
+                    post["allowed_reply"],
+                    journal.sent(key),
+                    lambda sent: journal.progress(key, sent),
+                ),
+                tweet_rejected,
+                find_tweet,
+            )
+            posted = True
+        except RateLimitExceeded as e:
+            # The post is sent once the limit has reset, without counting this as a failed attempt.
+            logger.info("Deferring post %s: %s" % (cid, e))
+            tweet_id = ""
+            outbox.schedule(cid, post, "twitter", t_fail, e, e.reset)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            t_fail += 1
+            tweet_id = ""
+            # If a tweet failes as a duplicate post, we don't want to try sending it again.
+            if "duplicate content" in str(e):
+                t_fail = settings.max_retries
+                tweet_id = "duplicate"
+            elif t_fail >= settings.max_retries:
+                logger.info("Error limit reached, not posting to Twitter")
+                tweet_id = "FailedToPost"
+            else:
+                outbox.schedule(cid, post, "twitter", t_fail, e)
+    else:
+        # The post replies to a post that was not sent to Twitter, so it can never be sent either.
+        logger.info("Not posting " + cid + " to Twitter")
+        outbox.settle(cid, ["twitter"])
+        if not tweet_id:
+            updates = True
             tweet_id = "skipped"
-            logger.info("Not posting to Twitter because posting was set to false.")
-        elif tweet_id and not post["repost"]:
-            logger.info("Post " + cid + " already sent to twitter.")
-        # if the post already exists and is a repost, we check if it has already been reposted, and if not, repost it.
-        elif tweet_id and post["repost"] and post["timestamp"] > repost_timelimit:
-            try:
-                # This is where retweets would go if they weren't locked behind a paywall.
-                pass
-                # retweet(tweet_id)
-                # posted = True
-            except Exception as e:
-                logger.error(traceback.format_exc())
-        # Trying to post to twitter and mastodon. If posting fails the post ID for each service is set to an
-        # empty string, letting the code know it should try again next time the code is run.
-        elif not tweet_id and tweet_reply not in [
-            "skipped",
-            "FailedToPost",
-            "duplicate",
-        ]:
+    return tweet_id, t_fail, posted, updates
+
+
+# Same as send_to_twitter, but for Mastodon.
+def send_to_mastodon(
+    cid, post, toot_id, m_fail, toot_reply, toot_quote, media, repost_timelimit
+):
+    posted = False
+    updates = False
+    # If mastodon is set to false, the post is not sent to mastodon.
+    if not post["mastodon"]:
+        toot_id = "skipped"
+        logger.info("Not posting to Mastodon because posting was set to false.")
+    elif toot_id and not post["repost"]:
+        logger.info("Post " + cid + " already sent to mastodon.")
+    # if the post already exists and is a repost, we check if it has already been reposted, and if not, repost it.
+    elif toot_id and post["repost"] and post["timestamp"] > repost_timelimit:
+        try:
+            retoot(toot_id)
+            posted = True
+        except Exception as e:
+            logger.error(traceback.format_exc())
+    elif not toot_id and outbox.waiting(cid, "mastodon"):
+        logger.info("Post " + cid + " is waiting to be sent to Mastodon again")
+    elif not toot_id and outbox.waiting(post["reply_to_post"], "mastodon"):
+        retry_at = outbox.next_attempt(post["reply_to_post"], "mastodon")
+        outbox.schedule(cid, post, "mastodon", m_fail, "Waiting for the post replied to", retry_at)
+    # Mastodon does not have a quote retweet function, so those will just be sent as replies.
+    # Every attempt at sending the same post uses the same idempotency key, so the instance does not post it twice
+    # within the lifetime of the key. After that, an interrupted attempt is looked up among the account's toots.
+    elif not toot_id and toot_reply not in ["skipped", "FailedToPost", "duplicate"]:
+        updates = True
+        try:
+            toot_id = journaled(
+                cid,
+                "mastodon",
+                post,
+                lambda key: toot(
+                    post["text"], toot_reply, toot_quote, media, post["visibility"], key
+                ),
+                toot_rejected,
+                find_toot,
+                IDEMPOTENCY_KEY_LIFETIME,
+            )
+            posted = True
+        except RateLimitExceeded as e:
+            logger.info("Deferring post %s: %s" % (cid, e))
+            toot_id = ""
+            outbox.schedule(cid, post, "mastodon", m_fail, e, e.reset)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            m_fail += 1
+            toot_id = ""
+            if m_fail >= settings.max_retries:
+                logger.info("Error limit reached, not posting to Mastodon")
+                toot_id = "FailedToPost"
+            else:
+                outbox.schedule(cid, post, "mastodon", m_fail, e)
+    else:
+        logger.info("Not posting " + cid + " to Mastodon")
+        outbox.settle(cid, ["mastodon"])
+        if not toot_id:
             updates = True
-            try:
-                tweet_id = tweet(
-                    post["text"], tweet_reply, tweet_quote, media, post["allowed_reply"]
-                )
-                posted = True
-            except Exception as e:
-                logger.error(traceback.format_exc())
-                t_fail += 1
-                tweet_id = ""
-                # If a tweet failes as a duplicate post, we don't want to try sending it again.
-                if "duplicate content" in str(e):
-                    t_fail = settings.max_retries
-                    tweet_id = "duplicate"
-        else:
-            logger.info("Not posting " + cid + " to Twitter")
-        # If mastodon is set to false, the post is not sent to mastodon.
-        if not post["mastodon"]:
             toot_id = "skipped"
-            logger.info("Not posting to Mastodon because posting was set to false.")
-        elif toot_id and not post["repost"]:
-            logger.info("Post " + cid + " already sent to mastodon.")
-        # if the post already exists and is a repost, we check if it has already been reposted, and if not, repost it.
-        elif toot_id and post["repost"] and post["timestamp"] > repost_timelimit:
-            try:
-                retoot(toot_id)
-                posted = True
-            except Exception as e:
-                logger.error(traceback.format_exc())
-        # Mastodon does not have a quote retweet function, so those will just be sent as replies.
-        elif not toot_id and toot_reply not in ["skipped", "FailedToPost", "duplicate"]:
-            updates = True
+    return toot_id, m_fail, posted, updates
+
+
+# Sends a post with send, which is given the idempotency key of the attempt, and records the attempt in the
+# publish journal before it is sent and its outcome after. If an earlier attempt was interrupted without an
+# answer, the post is first looked for with find, unless the platform still recognizes a retry by its key,
+# which it does for key_lifetime seconds, or the attempt got part of the way through a thread, in which case
+# the thread is resumed by send. rejected tells errors the platform answered with, meaning nothing was posted,
+# from those where it is unknown.
+def journaled(cid, platform, post, send, rejected, find=None, key_lifetime=0):
+    key = idempotency_key(cid, platform)
+    attempt = journal.pending(key)
+    sent = attempt.get("sent") if attempt else None
+    if attempt and find and not sent and attempt["time"] < arrow.utcnow().timestamp() - key_lifetime:
+        try:
+            post_id = find(attempt["text"], arrow.Arrow.fromtimestamp(attempt["time"]))
+        except Exception as e:
+            logger.error("Unable to look for earlier attempt at sending %s to %s: %s" % (cid, platform, e))
+            post_id = None
+        if post_id:
+            logger.info("Post %s was already sent to %s as %s" % (cid, platform, post_id))
+            journal.finish(key, post_id)
+            return post_id
+    journal.begin(cid, platform, post, sent)
+    try:
+        post_id = send(key)
+    except Exception as e:
+        # Once part of a thread has been sent, the attempt is kept so that the next one can resume it.
+        if (isinstance(e, RateLimitExceeded) or rejected(e)) and not journal.sent(key):
+            journal.fail(key, e)
+        raise
+    journal.finish(key, post_id)
+    return post_id
+
+
+# Saves posts that were sent by an earlier run but not saved to the database, because the crossposter stopped
+# before it got the chance, and compacts the publish journal. Posts whose outcome is unknown are looked up among
+# the tweets and toots of the accounts.
+def reconcile(database):
+    finders = {"twitter": (settings.Twitter, find_tweet), "mastodon": (settings.Mastodon, find_toot)}
+    for key, attempt in journal.read().items():
+        cid = attempt["cid"]
+        platform = attempt["platform"]
+        post_id = attempt.get("id")
+        enabled, find = finders[platform]
+        # A thread that was only partly sent is resumed when the post is sent again.
+        if attempt["state"] == "started" and enabled and not attempt.get("sent"):
             try:
-                toot_id = toot(
-                    post["text"], toot_reply, toot_quote, media, post["visibility"]
-                )
-                posted = True
+                post_id = find(attempt["text"], arrow.Arrow.fromtimestamp(attempt["time"]))
             except Exception as e:
-                logger.error(traceback.format_exc())
-                m_fail += 1
-                toot_id = ""
-        else:
-            logger.info("Not posting " + cid + " to Mastodon")
-        # Saving post to database
-        database = db_write(
-            cid, tweet_id, toot_id, {"twitter": t_fail, "mastodon": m_fail}, database
-        )
-        if posted:
-            post_cache[cid] = arrow.utcnow()
-    return updates, database, post_cache
+                logger.error("Unable to look for %s post of interrupted post %s: %s" % (platform, cid, e))
+            if post_id:
+                journal.finish(key, post_id)
+        if not post_id:
+            continue
+        ids = {"twitter_id": "", "mastodon_id": ""}
+        failed = {"twitter": 0, "mastodon": 0}
+        if cid in database:
+            ids = dict(database[cid]["ids"])
+            failed = database[cid]["failed"]
+        if ids[platform + "_id"] == post_id:
+            continue
+        logger.info("Saving post %s, which was sent to %s as %s before stopping" % (cid, platform, post_id))
+        ids[platform + "_id"] = post_id
+        db_write(cid, ids["twitter_id"], ids["mastodon_id"], failed, database)
+        outbox.settle(cid, [platform])
+    journal.compact()
+
+
+# Adds the posts in the outbox that are due to be sent again to the posts found in the feed, keeping the newest
+# first order post() expects. A post found in the feed is used instead of the one saved in the outbox.
+def with_due_retries(posts):
+    due = outbox.due()
+    if not due:
+        return posts
+    logger.info("Retrying %s post(s) from the outbox." % len(due))
+    posts = {**due, **posts}
+    return dict(sorted(posts.items(), key=lambda item: item[1]["timestamp"], reverse=True))
 
 
 # Function for getting included images. If no images are included, an empty list will be returned,
-# and the posting functions will know not to include any images.
+# and the posting functions will know not to include any images. The images are downloaded at the same time,
+# using the shared media client, so connections to the Bluesky CDN are reused between images and posts.
 def get_images(images):
-    local_images = []
-    for image in images:
-        # Giving the image just a random filename
-        filename = (
-            "".join(random.choice(string.ascii_lowercase) for i in range(10)) + ".jpg"
-        )
-        filename = image_path + filename
-        # Downloading fullsize version of image
-        urllib.request.urlretrieve(image["url"], filename)
-        # Saving image info in a dictionary and adding it to the list.
-        image_info = {"filename": filename, "alt": image["alt"]}
-        local_images.append(image_info)
-    return local_images
+    return list(media_downloader.map(get_image, images))
+
+
+def get_image(image):
+    # Downloading fullsize version of image, unless it is already in the media cache.
+    path = get_media(image["url"], media_key(image["url"]), "image")
+    # Saving image info in a dictionary and adding it to the list.
+    return media_info(path, image["alt"])
 
 
 def get_video(video_data):
-    # Giving the video just a random filename
-    filename = (
-        "".join(random.choice(string.ascii_lowercase) for i in range(10)) + ".mp4"
-    )
-    filename = image_path + filename
-    response = requests.get(video_data["url"])
-    if response.status_code != 200:
-        logger.error("Failed to download: %s." % response.text)
-        return
-    if "video" not in response.headers.get("Content-Type", ""):
-        logger.error("Response is not a valid video file.")
+    key = video_data.get("cid") or media_key(video_data["url"])
+    path = get_media(video_data["url"], key, "video")
+    if path is None:
         return
-    with open(filename, "wb") as f:
-        f.write(response.content)
-    logger.info("Video successfully downloaded to %s." % filename)
-    return [{"filename": filename, "alt": video_data["alt"]}]
+    return [media_info(path, video_data["alt"])]
+
+
+# The media cache is keyed by the CID of the blob on Bluesky, which is part of the image URLs on the CDN.
+# If there is no CID in the URL, a hash of the URL is used instead.
+def media_key(url):
+    match = CID_PATTERN.search(url)
+    if match:
+        return match.group(1)
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+# Returns the path of the media in the media cache, downloading it first if it is not already there.
+# The download is streamed to a temporary file in chunks, so that a large video never has to be held in
+# memory, and moved into the cache once it is complete.
+def get_media(url, key, media_type):
+    path = media_cache_find(key)
+    if path:
+        logger.info("Using cached %s %s." % (media_type, os.path.basename(path)))
+        return path
+    os.makedirs(image_path, exist_ok=True)
+    part_path = image_path + key + "." + random_filename(".part")
+    with media_client.stream("GET", url) as response:
+        if media_type == "image":
+            response.raise_for_status()
+        elif response.status_code != 200:
+            response.read()
+            logger.error("Failed to download: %s." % response.text)
+            return
+        mime_type = response.headers.get("Content-Type", "").split(";")[0]
+        if media_type == "video" and "video" not in mime_type:
+            logger.error("Response is not a valid video file.")
+            return
+        extension = mimetypes.guess_extension(mime_type) or DEFAULT_EXTENSIONS[media_type]
+        try:
+            with open(part_path, "wb") as file:
+                for chunk in response.iter_bytes(MEDIA_CHUNK_SIZE):
+                    file.write(chunk)
+        except Exception:
+            os.remove(part_path)
+            raise
+    path = image_path + key + extension
+    os.replace(part_path, path)
+    logger.info("%s successfully downloaded to %s." % (media_type.capitalize(), path))
+    return path
+
+
+def media_info(path, alt):
+    filename = os.path.basename(path)
+    return {
+        "file": MediaFile(path),
+        "filename": filename,
+        "mime_type": mimetypes.guess_type(filename)[0],
+        "alt": alt,
+    }
+
+
+def random_filename(extension):
+    return "".join(random.choice(string.ascii_lowercase) for i in range(10)) + extension
+
+
+# Media from the media cache. Twitter and Mastodon upload the same media at the same time, so each upload
+# reads it through its own reader from open(), which keeps its own position in the file.
+class MediaFile:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.size = os.path.getsize(path)
+        self.lock = threading.Lock()
+
+    def open(self):
+        return io.BufferedReader(MediaReader(self), MEDIA_CHUNK_SIZE)
+
+    def read_at(self, position, size):
+        with self.lock:
+            self.file.seek(position)
+            return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+class MediaReader(io.RawIOBase):
+    def __init__(self, media):
+        self.media = media
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.media.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        data = self.media.read_at(self.position, len(buffer))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
 
 
 def delete(deleted, post_cache, database):
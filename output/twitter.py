@@ -1,8 +1,63 @@
 import tweepy
+import html
+import re
 import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 from settings import settings
 from settings.auth import *
+from local.ratelimit import limiter
+
+# Endpoints used for rate limiting. Every request to Twitter is recorded by the rate limiter, and tweets and
+# media are only sent if the limits of these endpoints allow it.
+TWEET_ENDPOINT = "/2/tweets"
+MEDIA_ENDPOINT = "/1.1/media/upload.json"
+# URLs are shortened by Twitter, so they are left out when comparing the text of tweets.
+URL_PATTERN = re.compile(r"https?://\S+")
+# Tweet length is counted like twitter-text (version 3) does. Characters matched by HEAVY_CHARACTER_PATTERN,
+# e.g. CJK, count as two, and the rest (Latin, Greek, Cyrillic, Hebrew, Arabic, most Indic scripts and common
+# punctuation) as one. Every URL counts as the 23 characters of its t.co link, and every emoji counts as two
+# however many code points it is made of.
+URL_LENGTH = 23
+EMOJI_WEIGHT = 2
+HEAVY_CHARACTER_PATTERN = re.compile(r"[^\u0000-\u10ff\u2000-\u200d\u2010-\u201f\u2032-\u2037]")
+# Emoji are flags, keycaps and pictographs, along with their presentation selectors, skin tones, subdivision tags
+# and the pictographs joined to them by zero width joiners.
+EMOJI_BASE = (
+    "[\u00a9\u00ae\u203c\u2049\u2122\u2139\u2194-\u2199\u21a9\u21aa\u231a\u231b\u2328\u23cf"
+    "\u23e9-\u23f3\u23f8-\u23fa\u24c2\u25aa\u25ab\u25b6\u25c0\u25fb-\u25fe\u2600-\u27bf\u2934\u2935"
+    "\u2b05-\u2b07\u2b1b\u2b1c\u2b50\u2b55\u3030\u303d\u3297\u3299\U0001f000-\U0001faff]"
+    "[\ufe0e\ufe0f]?[\U0001f3fb-\U0001f3ff]?"
+)
+EMOJI = (
+    "[\U0001f1e6-\U0001f1ff]{2}|[#*0-9]\ufe0f?\u20e3"
+    "|%s(?:[\U000e0020-\U000e007e]+\U000e007f)?(?:\u200d%s)*" % (EMOJI_BASE, EMOJI_BASE)
+)
+# Punctuation at the end of a URL is not part of it. Twitter also links domains written without http(s)://,
+# which are counted as at least URL_LENGTH. Like twitter-text, domains are only taken for URLs when they end in
+# one of the common generic top level domains, or in a country code followed by a path, so that file names like
+# file.txt or node.js are counted as text.
+URL_END = r"(?=[.,:;!?'\")\]]*(?:\s|$))"
+GENERIC_TLDS = (
+    "com|net|org|edu|gov|mil|int|info|biz|name|pro|mobi|aero|app|dev|blog|news|online|site|shop|social|tech|xyz|co|tv"
+)
+ENTITY_PATTERN = re.compile(
+    r"(?P<url>https?://\S+?%s)"
+    r"|(?P<domain>(?<![\w@.\-/])(?i:(?:[a-z0-9][a-z0-9\-]*\.)+(?:(?:%s)(?:/\S*?)?|[a-z]{2}/\S*?))%s)"
+    r"|(?P<emoji>%s)" % (URL_END, GENERIC_TLDS, URL_END, EMOJI)
+)
+WORD_PATTERN = re.compile(r"\S+")
+# Twitter answers that a tweet is too long when it counts its length differently, e.g. for emoji that are newer
+# than the pattern above. The tweet is then split again this many percent below the maximum length.
+SPLIT_MARGIN = 10
+# Media is uploaded in chunks of up to 5 MB, the largest Twitter accepts.
+MEDIA_CHUNK_SIZE = 4 * 1024 * 1024
+MEDIA_PROCESSING_TIMEOUT = 300
+
+def record_rate_limit(response, *args, **kwargs):
+    limiter.record("twitter", response.url, response.headers)
+
 
 if settings.Twitter:
     # OAuth 1.0a User Authentication
@@ -22,6 +77,8 @@ if settings.Twitter:
         access_token_secret=TWITTER_ACCESS_TOKEN_SECRET,
         wait_on_rate_limit=False,  # Disable automatic rate limit handling
     )
+    twitter_api.session.hooks["response"].append(record_rate_limit)
+    twitter_client.session.hooks["response"].append(record_rate_limit)
 
 
 def set_reply_settings(allowed_reply):
@@ -39,42 +96,171 @@ def set_reply_settings(allowed_reply):
 def upload_media(media_items):
     """
     Uploads media files to Twitter and returns a list of media IDs.
+    All files of a post are uploaded at the same time, each while the others are processed.
+    """
+    with ThreadPoolExecutor(max_workers=len(media_items)) as executor:
+        return list(executor.map(upload_media_item, media_items))
+
+
+def upload_media_item(item):
     """
-    media_ids = []
-    for item in media_items:
-        alt_text = item.get("alt", "")
-        if len(alt_text) > 1000:
-            alt_text = alt_text[:996] + "..."
-        filename = item["filename"]
-        res = twitter_api.media_upload(filename)
-        media_id = res.media_id
-        if alt_text:
-            logger.info(f"Uploading media '{filename}' with ALT text to Twitter")
-            twitter_api.create_media_metadata(media_id, alt_text)
-        media_ids.append(media_id)
-    return media_ids
+    Uploads a single media file in chunks (INIT, APPEND, FINALIZE), waits for Twitter to process it
+    and adds the alt text. Returns the media ID.
+    """
+    alt_text = item.get("alt", "")
+    if len(alt_text) > 1000:
+        alt_text = alt_text[:996] + "..."
+    filename = item["filename"]
+    mime_type = item["mime_type"]
+    if mime_type == "image/gif":
+        media_category = "tweet_gif"
+    else:
+        media_category = "tweet_" + mime_type.split("/")[0]
+    logger.info(f"Uploading media '{filename}' to Twitter")
+    with item["file"].open() as file:
+        file.seek(0, 2)
+        total_bytes = file.tell()
+        file.seek(0)
+        media_id = twitter_api.chunked_upload_init(
+            total_bytes, mime_type, media_category=media_category
+        ).media_id
+        segment_index = 0
+        while chunk := file.read(MEDIA_CHUNK_SIZE):
+            twitter_api.chunked_upload_append(media_id, (filename, chunk), segment_index)
+            segment_index += 1
+    media = twitter_api.chunked_upload_finalize(media_id)
+    wait_for_processing(media)
+    if alt_text:
+        logger.info(f"Adding ALT text to media '{filename}' on Twitter")
+        twitter_api.create_media_metadata(media_id, alt_text)
+    return media_id
+
+
+def wait_for_processing(media):
+    """
+    Videos and GIFs are processed by Twitter after they have been uploaded, and can not be tweeted before
+    processing has finished. Checks the status as often as Twitter asks to until it is done.
+    """
+    deadline = time.monotonic() + MEDIA_PROCESSING_TIMEOUT
+    processing_info = getattr(media, "processing_info", None)
+    while processing_info and processing_info["state"] in ("pending", "in_progress"):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Media {media.media_id} was not processed in time")
+        time.sleep(processing_info.get("check_after_secs", 1))
+        status = twitter_api.get_media_upload_status(media.media_id)
+        processing_info = getattr(status, "processing_info", None)
+    if processing_info and processing_info["state"] == "failed":
+        raise tweepy.errors.TweepyException(
+            f"Processing media {media.media_id} failed: {processing_info.get('error')}"
+        )
+
+
+def tweet_length(text):
+    """
+    Returns the length of a text as counted by Twitter, where URLs count as 23 characters, emoji as two and
+    characters outside the Latin and other light scripts (e.g. CJK) as two.
+    """
+    text = unicodedata.normalize("NFC", text)
+    length = 0
+    position = 0
+    for match in ENTITY_PATTERN.finditer(text):
+        length += text_length(text[position : match.start()]) + entity_length(match)
+        position = match.end()
+    return length + text_length(text[position:])
+
+
+def text_length(text):
+    return len(text) + len(HEAVY_CHARACTER_PATTERN.findall(text))
+
+
+def entity_length(match):
+    if match.group("url"):
+        return URL_LENGTH
+    if match.group("domain"):
+        return max(len(match.group()), URL_LENGTH)
+    return EMOJI_WEIGHT
 
 
 def split_text_into_tweets(text, max_length=settings.max_tweet_length):
     """
-    Splits the text into a list of tweets, each not exceeding max_length.
+    Splits the text into a list of tweets, each not exceeding max_length as counted by tweet_length.
+    Tweets are split between words, keeping the whitespace between the words of each tweet. Words that are too
+    long for a tweet on their own, like text in languages written without spaces, are split between characters,
+    without splitting URLs, emoji or characters with combining marks.
     """
     logger.info("Splitting post that is too long for Twitter.")
-    words = text.split()
+    text = unicodedata.normalize("NFC", text)
     tweets = []
     current_tweet = ""
-    for word in words:
-        # +1 accounts for the space character
-        if len(current_tweet) + len(word) + 1 <= max_length:
-            current_tweet += (" " if current_tweet else "") + word
-        else:
+    current_length = 0
+    position = 0
+    for match in WORD_PATTERN.finditer(text):
+        space = text[position : match.start()] if current_tweet else ""
+        position = match.end()
+        word = match.group()
+        length = text_length(space) + tweet_length(word)
+        if current_length + length <= max_length:
+            current_tweet += space + word
+            current_length += length
+            continue
+        if current_tweet:
             tweets.append(current_tweet)
-            current_tweet = word
+        current_tweet = ""
+        current_length = 0
+        for part, part_length in word_parts(word):
+            if current_length + part_length > max_length and current_tweet:
+                tweets.append(current_tweet)
+                current_tweet = ""
+                current_length = 0
+            current_tweet += part
+            current_length += part_length
     if current_tweet:
         tweets.append(current_tweet)
     return tweets
 
 
+def word_parts(word):
+    """
+    Splits a word into the parts it can be split between, with their lengths: URLs, emoji and grapheme clusters.
+    """
+    position = 0
+    for match in ENTITY_PATTERN.finditer(word):
+        for cluster in grapheme_clusters(word[position : match.start()]):
+            yield cluster, text_length(cluster)
+        yield match.group(), entity_length(match)
+        position = match.end()
+    for cluster in grapheme_clusters(word[position:]):
+        yield cluster, text_length(cluster)
+
+
+def grapheme_clusters(text):
+    """
+    Splits a text into user-perceived characters: a character together with the combining marks, variation
+    selectors and joiners following it, or a pair of regional indicators.
+    """
+    cluster = ""
+    for char in text:
+        if cluster and (
+            unicodedata.category(char) in ("Mn", "Mc", "Me")
+            or char == "\u200d"
+            or cluster[-1] == "\u200d"
+            or "\U0001f3fb" <= char <= "\U0001f3ff"
+            or "\U000e0020" <= char <= "\U000e007f"
+            or (
+                "\U0001f1e6" <= char <= "\U0001f1ff"
+                and len(cluster) == 1
+                and "\U0001f1e6" <= cluster <= "\U0001f1ff"
+            )
+        ):
+            cluster += char
+            continue
+        if cluster:
+            yield cluster
+        cluster = char
+    if cluster:
+        yield cluster
+
+
 def post_tweet(
     text,
     reply_settings=None,
@@ -98,73 +284,125 @@ def post_tweet(
     return tweet_id
 
 
-def post_thread(text, initial_reply_to_id=None, media_ids=None):
+def post_thread(tweets, initial_reply_to_id=None, media_ids=None, sent_ids=None, record=None):
     """
-    Posts a thread of tweets if the text exceeds Twitter's character limit.
+    Posts a thread of tweets, made from a text that exceeds Twitter's character limit. Parts already posted by
+    an earlier attempt are given as sent_ids, and the thread is resumed from the first part that is missing.
+    After every part, record is called with the tweets of the thread and the IDs of the parts posted so far.
     """
-    tweets = split_text_into_tweets(text)
-    previous_tweet_id = initial_reply_to_id
-    for idx, tweet_text in enumerate(tweets):
+    ids = list(sent_ids or [])
+    previous_tweet_id = ids[-1] if ids else initial_reply_to_id
+    for idx in range(len(ids), len(tweets)):
         # Attach media only to the first tweet in the thread
         media = media_ids if idx == 0 else None
-        tweet_id = post_tweet(
-            text=tweet_text, in_reply_to_tweet_id=previous_tweet_id, media_ids=media
-        )
+        try:
+            tweet_id = post_tweet(
+                text=tweets[idx], in_reply_to_tweet_id=previous_tweet_id, media_ids=media
+            )
+        except Exception as e:
+            logger.error(f"Posting part {idx + 1}/{len(tweets)} to Twitter failed: {e}")
+            if isinstance(e, tweepy.errors.TooManyRequests):
+                raise limiter.exceeded("twitter", TWEET_ENDPOINT)
+            raise
+        ids.append(tweet_id)
+        if record:
+            record({"tweets": tweets, "ids": ids})
         previous_tweet_id = tweet_id
         logger.info(f"Posted part {idx + 1}/{len(tweets)} to Twitter")
     return previous_tweet_id
 
 
 def tweet(
-    post_text, reply_to_post=None, quote_post=None, media=None, allowed_reply=None
+    post_text, reply_to_post=None, quote_post=None, media=None, allowed_reply=None, sent=None, record=None
 ):
-    """Posts a tweet or thread to Twitter"""
-    if len(post_text) > settings.max_tweet_length:
+    """
+    Posts a tweet or thread to Twitter. Raises RateLimitExceeded, without sending anything, if the rate limit
+    does not allow all of it to be sent. If a thread was partly posted by an earlier attempt, sent holds the
+    tweets of the thread and the IDs of the parts that were posted, and only the rest of it is sent. record is
+    called with the same after every part of a thread, so that the progress can be saved.
+    """
+    if sent:
+        limiter.acquire("twitter", TWEET_ENDPOINT, len(sent["tweets"]) - len(sent["ids"]))
+        logger.info("Resuming thread from part %s" % (len(sent["ids"]) + 1))
+        return post_thread(sent["tweets"], reply_to_post, None, sent["ids"], record)
+    tweets = [post_text]
+    if tweet_length(post_text) > settings.max_tweet_length:
+        tweets = split_text_into_tweets(post_text)
+    if media:
+        limiter.acquire("twitter", MEDIA_ENDPOINT, len(media))
+    limiter.acquire("twitter", TWEET_ENDPOINT, len(tweets))
+    try:
+        media_ids = upload_media(media) if media else None
+    except tweepy.errors.TooManyRequests:
+        raise limiter.exceeded("twitter", MEDIA_ENDPOINT)
+    if len(tweets) > 1:
         logger.info("Text exceeds max length, creating thread...")
-        return post_thread(post_text, reply_to_post, media)
+        return post_thread(tweets, reply_to_post, media_ids, record=record)
 
-    MAX_RETRIES = 3
-    retries = 0
     reply_settings = set_reply_settings(allowed_reply)
-    media_ids = upload_media(media) if media else None
+    # Failed tweets are not retried right away, since a request that timed out may still have been posted.
+    # They are retried from the outbox, after the publish journal has been checked for them.
+    try:
+        return post_tweet(
+            text=post_text,
+            reply_settings=reply_settings,
+            quote_tweet_id=quote_post,
+            in_reply_to_tweet_id=reply_to_post,
+            media_ids=media_ids,
+        )
+    except tweepy.errors.BadRequest as e:
+        # Handle tweets that are too long
+        if "Too long" not in str(e):
+            raise
+        logger.warning("Tweet is too long. Attempting to split and repost as a thread.")
+        max_length = settings.max_tweet_length * (100 - SPLIT_MARGIN) // 100
+        return post_thread(
+            split_text_into_tweets(post_text, max_length), reply_to_post, media_ids, record=record
+        )
+    except tweepy.errors.TooManyRequests:
+        # The post is deferred until the limit resets, instead of being retried now.
+        raise limiter.exceeded("twitter", TWEET_ENDPOINT)
 
-    while retries <= MAX_RETRIES:
-        try:
-            # Attempt to post the tweet
-            tweet_id = post_tweet(
-                text=post_text,
-                reply_settings=reply_settings,
-                quote_tweet_id=quote_post,
-                in_reply_to_tweet_id=reply_to_post,
-                media_ids=media_ids,
-            )
-            return tweet_id
-        except tweepy.errors.BadRequest as e:
-            # Handle tweets that are too long
-            if "Too long" in str(e):
-                logger.warning(
-                    "Tweet is too long. Attempting to split and repost as a thread."
-                )
-                tweet_id = post_thread(post_text, reply_to_post, media_ids)
-                return tweet_id
-            else:
-                logger.error(f"BadRequest Error while posting tweet: {e}")
-                retries += 1
-        except tweepy.errors.TooManyRequests:
-            # Handle rate limits by skipping Twitter posting
-            logger.error("Rate limit exceeded on Twitter. Skipping Twitter posting.")
-            return None  # Exit the function without retrying
-        except tweepy.errors.TweepyException as e:
-            # Handle other Tweepy exceptions
-            logger.error(f"TweepyException occurred: {e}")
-            retries += 1
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}")
-            retries += 1
-    logger.error("Maximum retry limit reached. Skipping post.")
+
+def tweet_rejected(error):
+    """
+    Returns whether an error from tweet() was Twitter refusing the tweet, meaning that it was not posted. Server
+    errors are not, since the tweet may have been posted before the error, and neither are rate limits.
+    """
+    if not isinstance(error, tweepy.errors.HTTPException):
+        return False
+    status = error.response.status_code
+    return 400 <= status < 500 and status != 429
+
+
+def find_tweet(post_text, since):
+    """
+    Looks for a tweet of the post among the tweets the account has posted since the given time, for posts
+    that may have been tweeted without being saved. For threads, the first tweet is found, so the tweets are
+    compared with the first tweet of each way tweet() may have split the post.
+    Returns the tweet ID, or None if it was not found.
+    """
+    me = twitter_client.get_me(user_auth=True).data
+    response = twitter_client.get_users_tweets(
+        me.id,
+        user_auth=True,
+        start_time=since.to("UTC").format("YYYY-MM-DDTHH:mm:ss") + "Z",
+        max_results=20,
+    )
+    texts = {comparable_text(post_text)}
+    for max_length in (settings.max_tweet_length, settings.max_tweet_length * (100 - SPLIT_MARGIN) // 100):
+        if tweet_length(post_text) > max_length:
+            texts.add(comparable_text(split_text_into_tweets(post_text, max_length)[0]))
+    for tweet in response.data or []:
+        if comparable_text(tweet.text) in texts:
+            return str(tweet.id)
     return None
 
 
+def comparable_text(text):
+    return " ".join(URL_PATTERN.sub(" ", html.unescape(text)).split())
+
+
 def retweet(tweet_id):
     """
     Retweets a tweet by its ID.
@@ -2,6 +2,6 @@
 echo.
 echo Starting Crossposter...
 :loop
-python crosspost.py
-timeout /t 3600 /nobreak
+python crosspost.py --daemon
+timeout /t 60 /nobreak
 goto loop
\ No newline at end of file
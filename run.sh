@@ -1,7 +1,8 @@
 #!/bin/bash
 
-# Run once per hour if nothing else has been specified in environment variables
+# Runs the crossposter as a long-lived process that crossposts once per RUN_INTERVAL (defaults to one hour).
+# If the process stops for any reason it is restarted after a short pause.
 while :; do
-  python crosspost.py
-  sleep ${RUN_INTERVAL:-3600}
+  python crosspost.py --daemon
+  sleep 60
 done
\ No newline at end of file
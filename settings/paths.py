@@ -6,11 +6,33 @@ base_path = "./"
 # Path to the database file. If you want it somewhere other than directly in the base path you can
 # either write the entire path manually, or just add the rest of the path on top of the basePath.
 database_path = base_path + "db/database.json"
+# Path to the index of the database file, which allows looking up posts without reading the whole database.
+database_index_path = base_path + "db/database.idx"
+# Path to the number of posts and checksum of the database file, saved along with the database.
+database_meta_path = base_path + "db/database.meta"
+# Path to the log of changes made to the database since the last backup.
+database_changes_path = base_path + "db/database.changes"
+# Path to the folder of compressed archives of posts older than database_hot_days.
+archive_path = base_path + "db/archive/"
+# Path to the database when using the sqlite database backend.
+sqlite_database_path = base_path + "db/database.sqlite"
 # Path to the cache-file, which keeps track of recent posts, allowing you to limit posts per hours and
 # retweet yourself
 post_cache_path = base_path + "db/post.cache"
+# Path to the outbox of posts that failed to crosspost, and when they will be tried again
+outbox_path = base_path + "db/outbox.json"
+# Path to the journal of posts being sent, used to find posts that were sent but not saved if the crossposter stops
+publish_journal_path = base_path + "db/publish.journal"
 # Path to the session cache
 session_cache_path = base_path + "db/session.cache"
+# Path to the cache of DID documents of Bluesky users, used to find the server hosting their posts and media
+identity_cache_path = base_path + "db/identity.cache"
+# Path to the cache of the authors of posts that have been replied to
+reply_parent_cache_path = base_path + "db/reply_parents.cache"
+# Path to the high-water mark of the author feed, so that each run only fetches posts it has not seen yet
+feed_watermark_path = base_path + "db/feed.watermark"
+# Path to the Jetstream cursor, which lets streaming mode resume where it left off
+jetstream_state_path = base_path + "db/jetstream.cursor"
 # Path to backup of database.
 backup_path = base_path + "backups/" + "database.bak"
 # Path for storing logs
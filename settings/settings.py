@@ -59,8 +59,11 @@ cross_delete = True
 rate_limit_buffer = 10
 # Sets minimum log level i Loguru logger
 log_level = "INFO"
-# List of tags to ignore in posts. Posts containing any of these tags will be ignored. In case when you don't want some of posts to be synchronized.
+# Lists of tags to ignore in posts, for when you don't want some posts to be synchronized. Posts containing any of the
+# tags in ignore_tags_twitter are not posted to Twitter, and posts containing any of the tags in ignore_tags_mastodon
+# are not posted to Mastodon. A tag in both lists keeps the post from being crossposted at all.
 # Example: ignore_tags = ['#ignoreT']
+# Tags only match whole hashtags and are not case sensitive, so '#t' matches '#t', '#T' and '#t!' but not '#travel'.
 # Leave old tags on list if you want use other tag. Removing tag from the list will put ignored posts into list of posts to synchronize.
 ignore_tags_twitter = ["#t", "#exclusivebsky"]
 ignore_tags_mastodon = ["#m", "#nomastodon", "#exclusivebsky"]
@@ -69,6 +72,38 @@ ignore_tags_mastodon = ["#m", "#nomastodon", "#exclusivebsky"]
 max_tweet_length = (
     280  # Change to 4000 if you have that capability with Twitter Blue subscription
 )
+# run_interval sets the time (in seconds) between runs when the crossposter is started in daemon mode
+# (python crosspost.py --daemon).
+# Accepted values: Integers greater than 0
+run_interval = 3600
+# database_backend sets how the database of crossposted posts is stored. "json" keeps it in a single file that is
+# read into memory on every run, "sqlite" keeps it in an SQLite database where posts are looked up as needed.
+# An existing json database is imported the first time the sqlite backend is used.
+# Accepted values: json, sqlite
+database_backend = "json"
+# database_hot_days sets how many days posts are kept in the json database file. Older posts are moved to
+# compressed monthly archives in db/archive/, which are only read when a post is not found in the database file.
+# Set to 0 to keep all posts in the database file.
+# Accepted values: Integers, 0 or greater
+database_hot_days = 30
+# jetstream_url is the Jetstream endpoint used when the crossposter is started in streaming mode
+# (python crosspost.py --stream), where posts are crossposted as soon as they are made instead of once per run.
+jetstream_url = "wss://jetstream2.us-east.bsky.network/subscribe"
+# max_parallel_twitter and max_parallel_mastodon set how many requests are sent to each platform at the same time.
+# Twitter and Mastodon are always posted to in parallel.
+# Accepted values: Integers greater than 0
+max_parallel_twitter = 1
+max_parallel_mastodon = 2
+# max_parallel_posts sets how many posts are crossposted at the same time. Replies and quotes always wait for the post
+# they reply to or quote to be crossposted first.
+# Accepted values: Integers greater than 0
+max_parallel_posts = 4
+# Downloaded images and videos are kept in a cache, so that they don't have to be downloaded again when a post
+# is retried. media_cache_size sets the maximum size of the cache in megabytes, and media_cache_days sets how many
+# days files are kept since they were last used.
+# Accepted values: Integers greater than 0
+media_cache_size = 500
+media_cache_days = 7
 
 
 # Override settings with environment variables if they exist
@@ -140,6 +175,51 @@ cross_delete = (
     if os.environ.get("CROSS_DELETE")
     else cross_delete
 )
+run_interval = (
+    int(os.environ.get("RUN_INTERVAL"))
+    if os.environ.get("RUN_INTERVAL")
+    else run_interval
+)
+database_backend = (
+    os.environ.get("DATABASE_BACKEND")
+    if os.environ.get("DATABASE_BACKEND")
+    else database_backend
+)
+database_hot_days = (
+    int(os.environ.get("DATABASE_HOT_DAYS"))
+    if os.environ.get("DATABASE_HOT_DAYS")
+    else database_hot_days
+)
+jetstream_url = (
+    os.environ.get("JETSTREAM_URL")
+    if os.environ.get("JETSTREAM_URL")
+    else jetstream_url
+)
+max_parallel_twitter = (
+    int(os.environ.get("MAX_PARALLEL_TWITTER"))
+    if os.environ.get("MAX_PARALLEL_TWITTER")
+    else max_parallel_twitter
+)
+max_parallel_mastodon = (
+    int(os.environ.get("MAX_PARALLEL_MASTODON"))
+    if os.environ.get("MAX_PARALLEL_MASTODON")
+    else max_parallel_mastodon
+)
+max_parallel_posts = (
+    int(os.environ.get("MAX_PARALLEL_POSTS"))
+    if os.environ.get("MAX_PARALLEL_POSTS")
+    else max_parallel_posts
+)
+media_cache_size = (
+    int(os.environ.get("MEDIA_CACHE_SIZE"))
+    if os.environ.get("MEDIA_CACHE_SIZE")
+    else media_cache_size
+)
+media_cache_days = (
+    int(os.environ.get("MEDIA_CACHE_DAYS"))
+    if os.environ.get("MEDIA_CACHE_DAYS")
+    else media_cache_days
+)
 ignore_tags_twitter = (
     os.environ.get("IGNORE_TAGS_TWITTER").split(",")
     if os.environ.get("IGNORE_TAGS_TWITTER")
@@ -0,0 +1,126 @@
+import asyncio, json, os, sys, tempfile, unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Paths in settings are relative to the working directory, so logs and state files are written to a
+# temporary directory instead of the repository.
+os.chdir(tempfile.mkdtemp())
+
+from input import jetstream
+from local.ratelimit import limiter
+
+# The rate limiter saves its state when the process exits, after the test runner may have changed back.
+limiter.path = os.path.abspath(limiter.path)
+
+DID = "did:plc:test"
+
+
+def event(time_us, rkey):
+    return {
+        "did": DID,
+        "time_us": time_us,
+        "kind": "commit",
+        "commit": {
+            "operation": "create",
+            "collection": jetstream.POST_COLLECTION,
+            "rkey": rkey,
+            "cid": "cid" + rkey,
+        },
+    }
+
+
+# A stand-in for Jetstream, which sends the events from the cursor in the subscription URL on. Each
+# connection is given a list of batches to send, with a pause longer than BATCH_DELAY between them.
+class Server:
+    def __init__(self, events, connections):
+        self.events = events
+        self.connections = list(connections)
+        self.cursors = []
+
+    async def handle(self, websocket, path=None):
+        path = path or getattr(websocket, "path", None) or websocket.request.path
+        query = parse_qs(urlparse(path).query)
+        cursor = int(query["cursor"][0]) if "cursor" in query else None
+        self.cursors.append(cursor)
+        events = [e for e in self.events if cursor is None or e["time_us"] >= cursor]
+        for size in self.connections.pop(0) if self.connections else []:
+            for e in events[:size]:
+                await websocket.send(json.dumps(e))
+            events = events[size:]
+            await asyncio.sleep(jetstream.BATCH_DELAY * 3)
+
+
+class SubscribeTest(unittest.TestCase):
+    def setUp(self):
+        state_path = os.path.join(tempfile.mkdtemp(), "jetstream.json")
+        patches = [
+            mock.patch.object(jetstream, "jetstream_state_path", state_path),
+            mock.patch.object(jetstream, "BATCH_DELAY", 0.1),
+            mock.patch.object(jetstream, "CURSOR_REWIND_US", 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def subscribe(self, server, handler, reconnect=False, timeout=10):
+        async def run():
+            async with websockets.serve(server.handle, "127.0.0.1", 0) as websocket_server:
+                port = websocket_server.sockets[0].getsockname()[1]
+                url = "ws://127.0.0.1:%s/subscribe" % port
+                await asyncio.wait_for(jetstream.subscribe(DID, handler, url=url, reconnect=reconnect), timeout)
+
+        asyncio.run(run())
+
+    def test_batches_and_resumes_from_saved_cursor(self):
+        server = Server([event(100 + i, str(i)) for i in range(5)], [[3, 2], [5]])
+        batches = []
+
+        def handler(events, rkeys):
+            batches.append([e["time_us"] for e in events])
+            return True
+
+        self.subscribe(server, handler)
+        self.assertEqual(batches, [[100, 101, 102], [103, 104]])
+        self.assertEqual(jetstream.stream_state_read()["cursor"], 104)
+
+        # A new subscription resumes from the saved cursor instead of the live stream.
+        batches.clear()
+        self.subscribe(server, handler)
+        self.assertEqual(server.cursors, [None, 104])
+        self.assertEqual(batches, [[104]])
+
+    def test_failed_batch_is_received_again(self):
+        server = Server([event(100 + i, str(i)) for i in range(3)], [[1, 2], [3], [3]])
+        batches = []
+
+        def handler(events, rkeys):
+            batches.append([e["time_us"] for e in events])
+            if len(batches) == 2:
+                return False
+            if len(batches) == 3:
+                raise RuntimeError("crosspost failed")
+            return True
+
+        with mock.patch.object(jetstream.asyncio, "sleep", side_effect=fake_sleep):
+            with self.assertRaises(asyncio.TimeoutError):
+                self.subscribe(server, handler, reconnect=True, timeout=2)
+        # The second batch was not processed, so the cursor stayed at the first one and the batch was sent again,
+        # from the cursor on, on every new connection until the handler processed it.
+        self.assertEqual(batches[:4], [[100], [101, 102], [100, 101, 102], [100, 101, 102]])
+        self.assertEqual(server.cursors[:3], [None, 100, 100])
+        self.assertEqual(jetstream.stream_state_read()["cursor"], 102)
+
+
+real_sleep = asyncio.sleep
+
+
+# Skips the backoff before reconnecting, while still letting the stand-in pause between batches.
+async def fake_sleep(delay):
+    await real_sleep(min(delay, jetstream.BATCH_DELAY * 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import base64, json, os, sys, tempfile, threading, time, unittest
+from unittest import mock
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Paths in settings are relative to the working directory, so logs and state files are written to a
+# temporary directory instead of the repository.
+os.chdir(tempfile.mkdtemp())
+
+import local.functions as functions
+from local.functions import RateLimitedClient
+
+# The rate limiter saves its state when the process exits, after the test runner may have changed back.
+functions.limiter.path = os.path.abspath(functions.limiter.path)
+
+
+def jwt(scope, exp):
+    def encode(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+
+    payload = {"scope": scope, "sub": "did:plc:test", "iat": int(time.time()) - 7200, "exp": int(exp)}
+    return "%s.%s.%s" % (encode({"alg": "HS256", "typ": "JWT"}), encode(payload), encode("signature"))
+
+
+def session_response(access_exp):
+    return {
+        "accessJwt": jwt("com.atproto.access", access_exp),
+        "refreshJwt": jwt("com.atproto.refresh", time.time() + 86400),
+        "handle": "test.bsky.social",
+        "did": "did:plc:test",
+    }
+
+
+class SessionRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        patches = [
+            mock.patch.object(functions, "session_cache_write"),
+            mock.patch.object(functions.limiter, "record"),
+            mock.patch.object(functions, "BSKY_HANDLE", "test.bsky.social"),
+            mock.patch.object(functions, "BSKY_PASSWORD", "password"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def client(self, handler):
+        client = RateLimitedClient()
+        client.request._client = httpx.Client(transport=httpx.MockTransport(handler))
+        # A saved session whose access token has expired, so the next request refreshes it first.
+        expired = session_response(time.time() - 60)
+        client._set_session_common(
+            functions.models.ComAtprotoServerCreateSession.Response(**expired), client._base_url
+        )
+        return client
+
+    def handler(self, refresh_status, refresh_error):
+        def handle(request):
+            method = request.url.path.rsplit("/", 1)[-1]
+            self.calls.append(method)
+            if method == "com.atproto.server.refreshSession":
+                if refresh_status != 200:
+                    return httpx.Response(refresh_status, json={"error": refresh_error, "message": "x"})
+                return httpx.Response(200, json=session_response(time.time() + 7200))
+            if method == "com.atproto.server.createSession":
+                return httpx.Response(200, json=session_response(time.time() + 7200))
+            return httpx.Response(200, json={"did": "did:plc:test", "handle": "test.bsky.social"})
+
+        return handle
+
+    def resolve_handle(self, client):
+        # Run in a thread, so that a deadlock fails the test instead of hanging it.
+        thread = threading.Thread(
+            target=client.com.atproto.identity.resolve_handle, args=({"handle": "test.bsky.social"},), daemon=True
+        )
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "request did not finish, calls made: %s" % self.calls)
+
+    def test_expired_access_token_is_refreshed(self):
+        client = self.client(self.handler(200, None))
+        self.resolve_handle(client)
+        self.assertEqual(
+            self.calls, ["com.atproto.server.refreshSession", "com.atproto.identity.resolveHandle"]
+        )
+
+    def test_expired_refresh_token_logs_in_with_password(self):
+        client = self.client(self.handler(400, "ExpiredToken"))
+        self.resolve_handle(client)
+        self.assertEqual(
+            self.calls,
+            [
+                "com.atproto.server.refreshSession",
+                "com.atproto.server.createSession",
+                "com.atproto.identity.resolveHandle",
+            ],
+        )
+        self.assertGreater(client._session.access_jwt_payload.exp, time.time())
+        functions.session_cache_write.assert_called_once()
+
+    def test_other_refresh_errors_are_raised(self):
+        client = self.client(self.handler(400, "InvalidRequest"))
+        with self.assertRaises(functions.BadRequestError):
+            client.com.atproto.identity.resolve_handle({"handle": "test.bsky.social"})
+        self.assertEqual(self.calls, ["com.atproto.server.refreshSession"])
+
+
+if __name__ == "__main__":
+    unittest.main()